@@ -0,0 +1,63 @@
+import numpy as np
+
+_LETTERS = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+_PUNCTUATION = [".", ",", "?", "!", "!!", "...", ":)", "&"]
+_COMMON_MESSAGES = ["yes", "no", "Yes", "YES", "thanks", "ok", "stop", "hi", "Asc", "ndiyo", "haa", "maya"]
+
+def generate_vocabulary(size, seed=0):
+    """
+    Generates pseudo-words with SMS-like lengths
+    :param size: number of distinct words
+    :type size: int
+    :rtype: list(str)
+    """
+    rng = np.random.default_rng(seed)
+
+    words = set()
+    while len(words) < size:
+        lengths = rng.integers(1, 12, size=size)
+        letters = rng.choice(_LETTERS, size=(size, 12))
+        words.update("".join(word_letters[:length]) for word_letters, length in zip(letters, lengths))
+
+    return sorted(words)[:size]
+
+def generate_messages(n_messages, vocabulary_size, duplicate_rate=0.0, mean_length=8, seed=0):
+    """
+    Generates raw SMS-like messages offline.
+    Words are drawn from a Zipf distribution over a synthetic vocabulary, with some numbers, punctuation and
+    hyphenated words mixed in. A proportion of messages are exact duplicates of short, common messages
+    (keywords, "yes", "thanks") or of earlier messages.
+    :param n_messages: number of messages
+    :type n_messages: int
+    :param vocabulary_size: number of distinct words
+    :type vocabulary_size: int
+    :param duplicate_rate: proportion of messages which duplicate another message
+    :type duplicate_rate: float
+    :param mean_length: mean number of words per message
+    :type mean_length: int
+    :rtype: list(str)
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = np.array(generate_vocabulary(vocabulary_size, seed), dtype=object)
+
+    lengths = rng.geometric(1 / mean_length, size=n_messages)
+    ranks = rng.zipf(1.2, size=int(lengths.sum())) - 1
+    words = vocabulary[ranks % vocabulary_size]
+
+    numbers = rng.random(len(words)) < 0.03
+    words[numbers] = rng.integers(0, 10 ** 6, size=int(numbers.sum())).astype(str)
+    hyphenated = rng.random(len(words)) < 0.01
+    words[hyphenated] = [word[:1] + "-" + word[1:] for word in words[hyphenated]]
+
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    punctuation = rng.choice(_PUNCTUATION, size=n_messages)
+    messages = [" ".join(words[start:end]) + mark for start, end, mark in zip(offsets, offsets[1:], punctuation)]
+
+    duplicates = np.flatnonzero(rng.random(n_messages) < duplicate_rate)
+    for i in duplicates.tolist():
+        if i > 0 and rng.random() < 0.5:
+            messages[i] = messages[rng.integers(0, i)]
+        else:
+            messages[i] = _COMMON_MESSAGES[rng.integers(0, len(_COMMON_MESSAGES))]
+
+    return messages
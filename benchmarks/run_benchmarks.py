@@ -0,0 +1,292 @@
+"""
+Benchmarks the throughput and peak memory of the language_processing hot paths on synthetic SMS-like corpora.
+
+Run from the repository root, e.g.:
+    python -m benchmarks.run_benchmarks --sizes 10000 100000 --output results.json
+    python -m benchmarks.run_benchmarks --sizes 10000 100000 --baseline results.json
+
+Results are written as JSON. When a baseline produced by an earlier run is provided, each result is compared against
+the matching baseline result and the exit status is non-zero if any throughput dropped by more than the tolerance.
+"""
+import argparse
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from functools import cached_property
+
+import numpy as np
+import scipy
+import sklearn
+
+from core_ml_modules.language_processing import estimators, model_utils, Lexicon
+from benchmarks.corpus import generate_messages
+
+N_CLASSES = 30
+
+def _annotated_lexicon(tokenised_messages):
+    """
+    Builds a lexicon with a part of speech for half of its words
+    """
+    lexicon = Lexicon(tokenised_messages, ["pos_tag"])
+    lexicon.set_feature_values("pos_tag", *_pos_tags(lexicon))
+    return lexicon
+
+def _pos_tags(lexicon):
+    """
+    :return: half of the words of the lexicon, and a part of speech for each of them
+    :rtype: (list(str), list(str))
+    """
+    tags = ["Noun", "Verb", "Adj", "Adv"]
+    words = lexicon.get_words()[::2]
+    return words, [tags[(2 * i) % len(tags)] for i in range(len(words))]
+
+class _Fixtures:
+    """
+    Inputs of the benchmarks on a corpus, each built on first use so that only those of the benchmarks being run
+    are built
+    """
+    def __init__(self, raw_messages):
+        self.raw_messages = raw_messages
+
+    @cached_property
+    def tokenised_messages(self):
+        return estimators.Tokeniser().transform(self.raw_messages)
+
+    @cached_property
+    def encoded_messages(self):
+        return estimators.Tokeniser(output="ids").transform(self.raw_messages)
+
+    @cached_property
+    def lexicon(self):
+        return _annotated_lexicon(self.tokenised_messages)
+
+    def extractor(self, **params):
+        return estimators.NGramFrequencyExtractor(self.lexicon, ngram_range=(1, 2), **params)
+
+    @cached_property
+    def fitted_dict_extractor(self):
+        return self.extractor().fit(self.tokenised_messages)
+
+    @cached_property
+    def fitted_csr_extractor(self):
+        return self.extractor(engine="csr").fit(self.tokenised_messages)
+
+    @cached_property
+    def pos_extractor(self):
+        return self.extractor(form="pos_tag", default_form=model_utils.default_form_pos)
+
+    @cached_property
+    def pos_tags(self):
+        return _pos_tags(self.lexicon)
+
+    @cached_property
+    def scores(self):
+        """
+        :return: random scores for each message, the class with the best score for each message, and the classes
+        :rtype: (np.array, np.array, np.array)
+        """
+        rng = np.random.default_rng(0)
+        scores = rng.dirichlet(np.ones(N_CLASSES), size=len(self.raw_messages))
+        classes = np.array(["class_{}".format(i) for i in range(N_CLASSES)])
+        return scores, classes[scores.argmax(axis=1)], classes
+
+# Benchmark name -> fixtures it uses, built before it is timed, and function running it on the fixtures
+_BENCHMARKS = {
+    "tokenise": ([], lambda f: estimators.Tokeniser().transform(f.raw_messages)),
+    "tokenise_deduplicated": ([], lambda f: estimators.Tokeniser(deduplicate=True).transform(f.raw_messages)),
+    "tokenise_ids": ([], lambda f: estimators.Tokeniser(output="ids").transform(f.raw_messages)),
+    "lexicon_build": (["tokenised_messages"], lambda f: Lexicon(f.tokenised_messages, ["pos_tag"])),
+    "lexicon_build_encoded": (["encoded_messages"], lambda f: Lexicon(f.encoded_messages, ["pos_tag"])),
+    "lexicon_build_sharded": (["tokenised_messages"],
+                              lambda f: Lexicon.build(f.tokenised_messages, ["pos_tag"], n_jobs=-1)),
+    "lexicon_annotate": (["lexicon", "pos_tags"], lambda f: f.lexicon.set_feature_values("pos_tag", *f.pos_tags)),
+    "form_lookup": (["pos_extractor", "tokenised_messages"],
+                    lambda f: [f.pos_extractor.retrieve_lexical_form(message) for message in f.tokenised_messages]),
+    "ngram_fit_transform_dict": (["lexicon", "tokenised_messages"],
+                                 lambda f: f.extractor().fit_transform(f.tokenised_messages)),
+    "ngram_fit_transform_csr": (["lexicon", "tokenised_messages"],
+                                lambda f: f.extractor(engine="csr").fit_transform(f.tokenised_messages)),
+    "ngram_fit_transform_csr_encoded": (["lexicon", "encoded_messages"],
+                                        lambda f: f.extractor(engine="csr").fit_transform(f.encoded_messages)),
+    "ngram_fit_transform_pos": (["pos_extractor", "tokenised_messages"],
+                                lambda f: f.pos_extractor.fit_transform(f.tokenised_messages)),
+    "text_ngram_fit_transform_csr": (["lexicon"], lambda f: estimators.TextNGramFrequencyExtractor(
+        f.lexicon, ngram_range=(1, 2), engine="csr").fit_transform(f.raw_messages)),
+    "char_ngram_fit_transform": ([], lambda f: estimators.CharNGramFrequencyExtractor().fit_transform(f.raw_messages)),
+    "ngram_transform_dict": (["fitted_dict_extractor", "tokenised_messages"],
+                             lambda f: f.fitted_dict_extractor.transform(f.tokenised_messages)),
+    "ngram_transform_csr": (["fitted_csr_extractor", "tokenised_messages"],
+                            lambda f: f.fitted_csr_extractor.transform(f.tokenised_messages)),
+    "ngram_transform_hashing": (["lexicon", "tokenised_messages"],
+                                lambda f: f.extractor(n_features=2 ** 20).transform(f.tokenised_messages)),
+    "ngram_fit_transform_deduplicated": (["lexicon", "tokenised_messages"],
+                                         lambda f: f.extractor(engine="csr", deduplicate=True).fit_transform(
+                                             f.tokenised_messages)),
+    "select_predicted_scores": (["scores"], lambda f: model_utils.select_predicted_scores(*f.scores)),
+    "rank_predicted_scores": (["scores"], lambda f: model_utils.rank_predicted_scores(f.scores[0], f.scores[2], k=3))
+}
+
+# Benchmarks running in worker processes, whose memory tracemalloc cannot see
+_PROCESS_POOL_BENCHMARKS = {"lexicon_build_sharded"}
+
+def _time(function, repeat):
+    """
+    :return: the fastest of repeat runs of function, in seconds
+    :rtype: float
+    """
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def _peak_memory(function):
+    """
+    :return: peak memory allocated while running function, in bytes. Measured in a separate run from the timings
+             because tracing allocations slows everything down.
+    :rtype: int
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def run(sizes, vocabulary_sizes, duplicate_rates, benchmark_names=None, repeat=3, measure_memory=True):
+    """
+    Runs every benchmark on a synthetic corpus for every combination of corpus size, vocabulary size and
+    duplicate rate
+    :param benchmark_names: names of the benchmarks to run, or None to run all of them
+    :type benchmark_names: list(str) | None
+    :rtype: list(dict)
+    """
+    results = []
+    for n_messages in sizes:
+        for vocabulary_size in vocabulary_sizes:
+            for duplicate_rate in duplicate_rates:
+                fixtures = _Fixtures(generate_messages(n_messages, vocabulary_size, duplicate_rate))
+
+                for name, (fixture_names, run_benchmark) in _BENCHMARKS.items():
+                    if benchmark_names is not None and name not in benchmark_names:
+                        continue
+
+                    for fixture_name in fixture_names:
+                        getattr(fixtures, fixture_name)
+
+                    def function():
+                        return run_benchmark(fixtures)
+
+                    seconds = _time(function, repeat)
+                    # Peak memory is not recorded rather than underestimated for benchmarks using worker processes
+                    measure_peak_memory = measure_memory and name not in _PROCESS_POOL_BENCHMARKS
+                    result = {
+                        "benchmark": name,
+                        "n_messages": n_messages,
+                        "vocabulary_size": vocabulary_size,
+                        "duplicate_rate": duplicate_rate,
+                        "seconds": seconds,
+                        "messages_per_second": n_messages / seconds if seconds > 0 else None,
+                        "peak_memory_bytes": _peak_memory(function) if measure_peak_memory else None
+                    }
+                    results.append(result)
+                    print("{benchmark:<35} n={n_messages:<9} vocabulary={vocabulary_size:<8} "
+                          "duplicates={duplicate_rate:<5} {seconds:9.3f}s".format(**result), file=sys.stderr)
+
+    return results
+
+def compare(results, baseline_results, tolerance):
+    """
+    Compares results against those of a baseline run with the same parameters
+    :param tolerance: largest acceptable relative drop in throughput (e.g. 0.2 for 20%)
+    :type tolerance: float
+    :return: comparisons of each result which has a baseline, including whether it regressed
+    :rtype: list(dict)
+    """
+    def key(result):
+        return result["benchmark"], result["n_messages"], result["vocabulary_size"], result["duplicate_rate"]
+
+    baseline_by_key = {key(result): result for result in baseline_results}
+
+    comparisons = []
+    for result in results:
+        baseline = baseline_by_key.get(key(result))
+        if baseline is None or not baseline["messages_per_second"] or not result["messages_per_second"]:
+            continue
+
+        throughput_ratio = result["messages_per_second"] / baseline["messages_per_second"]
+        memory_ratio = None
+        if result["peak_memory_bytes"] and baseline["peak_memory_bytes"]:
+            memory_ratio = result["peak_memory_bytes"] / baseline["peak_memory_bytes"]
+
+        comparisons.append({
+            "benchmark": result["benchmark"],
+            "n_messages": result["n_messages"],
+            "vocabulary_size": result["vocabulary_size"],
+            "duplicate_rate": result["duplicate_rate"],
+            "throughput_ratio": throughput_ratio,
+            "peak_memory_ratio": memory_ratio,
+            "regressed": throughput_ratio < 1 - tolerance
+        })
+
+    return comparisons
+
+def _metadata():
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "scikit-learn": sklearn.__version__
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the language_processing hot paths")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000],
+                        help="Numbers of messages in the synthetic corpora (e.g. 10000 100000 1000000 5000000)")
+    parser.add_argument("--vocabulary-sizes", type=int, nargs="+", default=[20000],
+                        help="Numbers of distinct words in the synthetic corpora")
+    parser.add_argument("--duplicate-rates", type=float, nargs="+", default=[0.0, 0.4],
+                        help="Proportions of exact duplicate messages in the synthetic corpora")
+    parser.add_argument("--benchmarks", nargs="+", default=None, help="Benchmarks to run (all by default)")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of timed runs, of which the fastest is kept")
+    parser.add_argument("--no-memory", action="store_true", help="Skip peak memory measurements")
+    parser.add_argument("--output", default=None, help="JSON file to write the results to (stdout by default)")
+    parser.add_argument("--baseline", default=None, help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Largest acceptable relative drop in throughput compared to the baseline")
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.vocabulary_sizes, args.duplicate_rates, args.benchmarks, args.repeat,
+                  not args.no_memory)
+    output = {"metadata": _metadata(), "results": results}
+
+    regressed = False
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            output["comparisons"] = compare(results, json.load(f)["results"], args.tolerance)
+        for comparison in output["comparisons"]:
+            if comparison["regressed"]:
+                regressed = True
+                print("Regression: {benchmark} n={n_messages} vocabulary={vocabulary_size} "
+                      "duplicates={duplicate_rate}: throughput x{throughput_ratio:.2f}".format(**comparison),
+                      file=sys.stderr)
+
+    if args.output is None:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+
+    return 1 if regressed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1 +1,2 @@
-from .lexicon import Lexicon
+from .lexicon import Lexicon, WordSet
+from .vocabulary import Vocabulary, EncodedMessages
@@ -1,17 +1,60 @@
+import importlib
+import itertools
+import json
+import math
+import numbers
+import os
 import re
+import warnings
+from array import array
 from collections import Counter
 
-import nltk
+import numpy as np
+import scipy.sparse as sp
 
 from sklearn.base import BaseEstimator
 from sklearn.pipeline import TransformerMixin
-from sklearn.feature_extraction import DictVectorizer
+from sklearn.feature_extraction import DictVectorizer, FeatureHasher
+from sklearn.preprocessing import normalize
+from sklearn.utils import murmurhash3_32
+
+from .model_utils import default_form_word
+from .parallel_utils import get_n_workers, iter_chunks, map_chunks_in_processes
+from .vocabulary import Vocabulary, EncodedMessages
+
+_TOKEN_PATTERN = re.compile(r"[a-zA-Z0-9]+('[a-zA-Z])?|\(+|\)+|\?+|[^a-zA-Z0-9\s]+(\s+[^a-zA-Z0-9\s]+)*")
 
 class Tokeniser(BaseEstimator, TransformerMixin):
     """
     Transformer object tokenising messages with a specific tokeniser
     Sci-kit learn documentation on creating estimators: http://scikit-learn.org/dev/developers/contributing.html#rolling-your-own-estimator
     """
+    OUTPUTS = ("tokens", "ids")
+
+    def __init__(self, n_jobs=None, chunk_size=10000, deduplicate=False, output="tokens", vocabulary=None):
+        """
+        :param n_jobs: number of worker processes to tokenise with. None or 1 tokenises in the current process,
+                       -1 uses one process per CPU.
+        :type n_jobs: int | None
+        :param chunk_size: number of messages sent to a worker process at a time
+        :type chunk_size: int
+        :param deduplicate: whether transform tokenises each distinct message only once.
+                            Identical messages then share the same list of tokens in the output.
+        :type deduplicate: bool
+        :param output: "tokens" for transform to return a list of lists of str, or "ids" to return EncodedMessages
+        :type output: str
+        :param vocabulary: vocabulary tokens are encoded with when output is "ids". New tokens are added to it.
+                           A new vocabulary is created on first use if None, and kept as vocabulary_.
+        :type vocabulary: Vocabulary | None
+        """
+        assert output in self.OUTPUTS, "Invalid output '{}', must be one of {}".format(output, self.OUTPUTS)
+
+        self.n_jobs = n_jobs
+        self.chunk_size = chunk_size
+        self.deduplicate = deduplicate
+        self.output = output
+        self.vocabulary = vocabulary
+
     def fit(self, X, y=None):
         """
         Fit simply returns self, no other information is needed.
@@ -28,13 +71,43 @@ class Tokeniser(BaseEstimator, TransformerMixin):
         """
         Tokenises messages
         """
-        tokenised_messages = []
+        if self.deduplicate:
+            unique_messages, inverse = _deduplicate(messages)
+            tokenised_messages = self._transform(unique_messages)
+            tokenised_messages = [tokenised_messages[i] for i in inverse]
+        else:
+            tokenised_messages = self._transform(messages)
 
-        for message in messages:
-            tokenised_messages.append(self.tokenise(message))
+        if self.output == "ids":
+            if not hasattr(self, "vocabulary_"):
+                self.vocabulary_ = Vocabulary() if self.vocabulary is None else self.vocabulary
+            return EncodedMessages.encode(tokenised_messages, self.vocabulary_)
 
         return tokenised_messages
 
+    def _transform(self, messages):
+        if get_n_workers(self.n_jobs) == 1:
+            return [self.tokenise(message) for message in messages]
+
+        return list(self.iter_transform(messages))
+
+    def iter_transform(self, messages):
+        """
+        Tokenises messages lazily, e.g. when streaming them from a file.
+        Tokenised messages are yielded in the same order as the input.
+        :type messages: iterable of str
+        :rtype: generator of list of str
+        """
+        n_workers = get_n_workers(self.n_jobs)
+        if n_workers == 1:
+            for message in messages:
+                yield self.tokenise(message)
+            return
+
+        for tokenised_chunk in map_chunks_in_processes(_tokenise_chunk, iter_chunks(messages, self.chunk_size),
+                                                       n_workers):
+            yield from tokenised_chunk
+
     def tokenise(self, input_string):
         """
         Tokenises a string, removing hyphens and replacing "&" with "and" in the process.
@@ -43,11 +116,16 @@ class Tokeniser(BaseEstimator, TransformerMixin):
         :return: List of tokens
         :rtype: list of str
         """
-        output = []
-        for m in re.finditer("[a-zA-Z0-9]+(\'[a-zA-Z])?|\(+|\)+|\?+|[^a-zA-Z0-9\s]+(\s+[^a-zA-Z0-9\s]+)*",
-                             re.sub("-", "", input_string)):
-            output.append(m.group())
-        return output
+        return _tokenise(input_string)
+
+def _tokenise(input_string):
+    return [m.group() for m in _TOKEN_PATTERN.finditer(input_string.replace("-", ""))]
+
+def _tokenise_chunk(messages):
+    """
+    Tokenises a chunk of messages in a worker process
+    """
+    return [_tokenise(message) for message in messages]
 
 class NGramFrequencyExtractor(BaseEstimator, TransformerMixin):
     """
@@ -55,39 +133,157 @@ class NGramFrequencyExtractor(BaseEstimator, TransformerMixin):
     Sci-kit learn documentation on creating estimators: http://scikit-learn.org/dev/developers/contributing.html#rolling-your-own-estimator
     """
 
-    def __init__(self, lexicon, form=None, default_form=lambda word, lexicon: word, ngram_size=1, adjust_for_message_len=True):
+    ENGINES = ("dict", "csr")
+    NORMS = (None, "l1", "l2")
+    MAX_DEFAULT_FORMS = 2 ** 20     # Bounds the memoised default forms of words not in the lexicon
+    CHUNK_SIZE = 10000              # Number of messages whose ngrams are counted at a time when pruning
+    SKETCH_WIDTH = 2 ** 20          # Smallest number of counters in each row of the sketch of document frequencies
+    MAX_SKETCH_WIDTH = 2 ** 23      # Largest number of counters in each row of the sketch, however large the corpus
+    SKETCH_COUNTERS_PER_MESSAGE = 8     # Counters in each row of the sketch per message, if the corpus size is known
+    SKETCH_DEPTH = 4                # Number of rows of the sketch of ngram document frequencies
+    HEAVY_HITTERS_FACTOR = 10       # With max_features, how many times more candidate ngrams are kept while counting
+    FORMAT_VERSION = 2
+
+    def __init__(self, lexicon, form=None, default_form=default_form_word, ngram_size=1, adjust_for_message_len=True,
+                 engine="dict", n_features=None, alternate_sign=True, ngram_range=None, deduplicate=False, min_df=1,
+                 max_df=1.0, max_features=None, dtype=np.float64, norm=None):
+        """
+        :param ngram_size: size of the ngrams to count
+        :type ngram_size: int
+        :param ngram_range: (min_n, max_n) to count ngrams of every size from min_n to max_n inclusive in a single pass
+                            over each message. Overrides ngram_size if set. When adjusting for message length,
+                            frequencies are relative to the total number of ngrams of all sizes in the message.
+        :type ngram_range: (int, int) | None
+        :param engine: "dict" builds a frequency dict per message and vectorises them with a DictVectorizer;
+                       "csr" builds the sparse matrix directly from the ngrams using a fitted vocabulary,
+                       without intermediate dicts or joined ngram strings. Both produce identical output.
+        :type engine: str
+        :param n_features: if set, ngrams are hashed into this many columns instead of being looked up in a fitted
+                           vocabulary (the hashing trick). No vocabulary is kept, so transform does not need fitting
+                           and memory does not grow with the number of distinct ngrams. The engine is then unused.
+        :type n_features: int | None
+        :param alternate_sign: in hashing mode, whether the sign of each hashed value is also determined by the hash,
+                               so that collisions tend to cancel out rather than accumulate
+        :type alternate_sign: bool
+        :param deduplicate: whether identical messages are only processed once, their result being shared by
+                            (dicts) or copied to (matrix rows) every occurrence
+        :type deduplicate: bool
+        :param min_df: ngrams in fewer messages than this are left out of the vocabulary when fitting.
+                       A float is a proportion of the messages, an int a number of messages.
+        :type min_df: int | float
+        :param max_df: ngrams in more messages than this are left out of the vocabulary when fitting (e.g. to leave out
+                       ngrams too common to be informative). A float is a proportion of the messages, an int a number
+                       of messages.
+        :type max_df: int | float
+        :param max_features: if set, only this many ngrams, those in the most messages, are kept in the vocabulary
+        :type max_features: int | None
+        :param dtype: type of the values of the frequency matrix, e.g. np.float32 to halve its memory
+        :type dtype: type
+        :param norm: "l1" or "l2" to scale each row of the frequency matrix to unit norm, after adjusting for message
+                     length if that is enabled, or None to leave rows unscaled
+        :type norm: str | None
+
+        When pruning the vocabulary with min_df, max_df or max_features, fitting reads the messages twice, so they must
+        be re-iterable (e.g. a list or EncodedMessages, not a generator). The first pass estimates document frequencies
+        with a count-min sketch in bounded memory to find candidate ngrams: those estimated to be in at least min_df
+        messages when min_df is an int, and only the HEAVY_HITTERS_FACTOR * max_features most frequent ngrams when
+        max_features is set. The second pass counts the document frequencies of the candidates exactly, so pruning
+        does not keep ngrams whose frequency was overestimated.
+        """
+        assert engine in self.ENGINES, "Invalid engine '{}', must be one of {}".format(engine, self.ENGINES)
+        assert norm in self.NORMS, "Invalid norm '{}', must be one of {}".format(norm, self.NORMS)
+
         self.lexicon = lexicon
         self.form = form
         self.default_form = default_form
         self.ngram_size = ngram_size
-        self.vectorizer = DictVectorizer()
+        self.vectorizer = DictVectorizer(dtype=dtype)
         self.adjust_for_message_len = adjust_for_message_len
+        self.engine = engine
+        self.n_features = n_features
+        self.alternate_sign = alternate_sign
+        self.ngram_range = ngram_range
+        self.deduplicate = deduplicate
+        self.min_df = min_df
+        self.max_df = max_df
+        self.max_features = max_features
+        self.dtype = dtype
+        self.norm = norm
+
+        assert n_features is None or not self._is_pruning(), \
+            "min_df, max_df and max_features cannot be used in hashing mode, where there is no vocabulary"
 
     def extract_frequency_dicts(self, X):
-        frequency_dicts = []
+        if self.deduplicate:
+            unique_X, inverse = _deduplicate(X, key=tuple)
+            frequency_dicts = self._extract_frequency_dicts(unique_X)
+            return [frequency_dicts[i] for i in inverse]
+
+        return self._extract_frequency_dicts(X)
+
+    def _extract_frequency_dicts(self, X):
+        return list(self._iter_frequency_dicts(X))
+
+    def _iter_frequency_dicts(self, X, ngram_counts=None):
+        """
+        :param ngram_counts: if given, the number of ngrams in each message is appended to it and frequency dicts hold
+                             counts, rather than being adjusted for message length
+        :type ngram_counts: array | None
+        """
         for message in X:
-            tuple_ngrams = nltk.ngrams(self.retrieve_lexical_form(message), self.ngram_size)
-            string_ngrams = []
-            for ngram in tuple_ngrams:
-                string_ngrams.append(",".join(ngram))
+            string_ngrams = [",".join(ngram) for ngram in self._ngrams(self.retrieve_lexical_form(message))]
 
             frequency_dict = Counter(string_ngrams)
-            if self.adjust_for_message_len:
+            if ngram_counts is not None:
+                ngram_counts.append(len(string_ngrams))
+            elif self.adjust_for_message_len:
                 for ngram in frequency_dict:
                     frequency_dict[ngram] = frequency_dict[ngram] / len(string_ngrams)
 
-            frequency_dicts.append(frequency_dict)
-
-        return frequency_dicts
+            yield frequency_dict
 
     def fit(self, X, y=None):
         """
-        Determines the list of tokens and ngrams to be used
-        :param X: List of tokenised messages
-        :type X: list(list(str))
+        Determines the list of tokens and ngrams to be used.
+        X is only iterated over once, so it can be an iterator over a corpus which does not fit in memory, unless
+        deduplicating: memory then grows with the number of distinct ngrams rather than the number of messages.
+        When pruning the vocabulary, X is iterated over twice, so it must be re-iterable rather than an iterator.
+        :param X: tokenised messages
+        :type X: iterable of list(str) | EncodedMessages
         """
-        frequency_dicts = self.extract_frequency_dicts(X)
-        self.vectorizer.fit(frequency_dicts)
+        self._feature_table = None
+        if self.n_features is not None:
+            return self
+
+        if self._is_pruning():
+            assert iter(X) is not X, \
+                "Pruning the vocabulary reads the messages twice, so they must be re-iterable (e.g. a list), " \
+                "not an iterator"
+            ngrams = self._find_frequent_ngrams(X)
+            if self.engine == "csr":
+                self._set_vocabulary(ngrams)
+            else:
+                self.vectorizer.fit([dict.fromkeys((",".join(ngram) for ngram in ngrams), 1)])
+            return self
+
+        if isinstance(X, EncodedMessages) and self.engine == "csr":
+            ngrams = set()
+            for _, _, distinct_ngrams in self._encoded_ngrams(X):
+                ngrams.update(distinct_ngrams)
+            self._set_vocabulary(ngrams)
+            return self
+
+        if self.deduplicate:
+            X, _ = _deduplicate(X, key=tuple)
+
+        if self.engine == "csr":
+            ngrams = set()
+            for message in X:
+                ngrams.update(self._ngrams(self.retrieve_lexical_form(message)))
+            self._set_vocabulary(ngrams)
+            return self
+
+        self.vectorizer.fit(self._iter_frequency_dicts(X))
         return self
 
     def transform(self, X, y=None):
@@ -96,8 +292,35 @@ class NGramFrequencyExtractor(BaseEstimator, TransformerMixin):
         :return: frequency vectors
         :rtype: numpy array of shape [n_samples, n_features]
         """
-        frequency_dicts = self.extract_frequency_dicts(X)
-        return self.vectorizer.transform(frequency_dicts)
+        if self.deduplicate and not isinstance(X, EncodedMessages):
+            unique_X, inverse = _deduplicate(X, key=tuple)
+            return self._transform(unique_X)[inverse]
+
+        return self._transform(X)
+
+    def _transform(self, X):
+        if getattr(self, "_feature_table", None) is not None:
+            if not isinstance(X, EncodedMessages):
+                X = EncodedMessages.encode(X)
+            return self._build_encoded_matrix(X, self._encoded_ngrams(X), self._look_up_feature_table,
+                                              len(self._feature_table[0]))
+
+        if self.n_features is not None:
+            if isinstance(X, EncodedMessages):
+                return self._build_encoded_matrix(X, self._encoded_ngrams(X), self._hash_ngrams, self.n_features)
+            return self._hash_matrix(X)
+
+        if self.engine == "csr":
+            if not hasattr(self, "vocabulary_"):
+                raise AttributeError("No vocabulary, object has not been fitted")
+            if isinstance(X, EncodedMessages):
+                return self._build_encoded_matrix(X, self._encoded_ngrams(X), self._look_up_ngrams,
+                                                  len(self.feature_names_))
+            return self._normalise(*self._build_matrix(X, self.vocabulary_))
+
+        ngram_counts = array("d")
+        matrix = self.vectorizer.transform(self._iter_frequency_dicts(X, ngram_counts))
+        return self._normalise(matrix, ngram_counts)
 
     def fit_transform(self, X, y=None, **fit_params):
         """
@@ -105,32 +328,974 @@ class NGramFrequencyExtractor(BaseEstimator, TransformerMixin):
         :return: frequency vectors
         :rtype: numpy array of shape [n_samples, n_features]
         """
-        frequency_dicts = self.extract_frequency_dicts(X)
-        return self.vectorizer.fit_transform(frequency_dicts)
+        if self._is_pruning():
+            # Document frequencies have to be known before anything can be counted, so X must be re-iterable, which
+            # fit checks
+            return self.fit(X).transform(X)
+
+        if self.deduplicate and not isinstance(X, EncodedMessages):
+            unique_X, inverse = _deduplicate(X, key=tuple)
+            return self._fit_transform(unique_X)[inverse]
+
+        return self._fit_transform(X)
+
+    def _fit_transform(self, X):
+        self._feature_table = None
+        if self.n_features is not None:
+            return self._transform(X)
+
+        if isinstance(X, EncodedMessages) and self.engine == "csr":
+            encoded_ngrams = list(self._encoded_ngrams(X))
+            self._set_vocabulary(set().union(*(distinct_ngrams for _, _, distinct_ngrams in encoded_ngrams)))
+            return self._build_encoded_matrix(X, encoded_ngrams, self._look_up_ngrams, len(self.feature_names_))
+
+        if self.engine == "csr":
+            # Columns are numbered in order of first appearance while counting, then renumbered into the sorted
+            # feature name order once the whole vocabulary is known.
+            provisional_vocabulary = {}
+            matrix, ngram_counts = self._build_matrix(X, provisional_vocabulary, grow=True)
+            provisional_ngrams = list(provisional_vocabulary)
+            self._set_vocabulary(provisional_ngrams)
+
+            permutation = np.fromiter((self.vocabulary_[ngram] for ngram in provisional_ngrams),
+                                      dtype=matrix.indices.dtype, count=len(provisional_ngrams))
+            matrix = sp.csr_matrix((matrix.data, permutation[matrix.indices], matrix.indptr),
+                                   shape=(matrix.shape[0], len(self.feature_names_)))
+            # ngrams whose joined strings coincide share a column and have to be summed
+            matrix.sum_duplicates()
+            return self._normalise(matrix, ngram_counts)
+
+        ngram_counts = array("d")
+        matrix = self.vectorizer.fit_transform(self._iter_frequency_dicts(X, ngram_counts))
+        return self._normalise(matrix, ngram_counts)
+
+    def partial_fit(self, X, y=None):
+        """
+        Fits on a batch of messages, so that batches can be streamed through without holding them all in memory.
+        In hashing mode there is no vocabulary to update. With the csr engine, ngrams not seen in earlier batches are
+        added to the vocabulary as new columns after the existing ones, so the columns of ngrams already seen do not
+        change between batches, and feature names are in order of first batch rather than sorted.
+        :param X: tokenised messages
+        :type X: iterable of list(str) | EncodedMessages
+        """
+        if self.n_features is not None:
+            return self
+
+        assert self.engine == "csr", "partial_fit is only supported in hashing mode or by the csr engine"
+        assert getattr(self, "_feature_table", None) is None, "A loaded extractor cannot be fitted incrementally"
+        assert not self._is_pruning(), "partial_fit cannot prune the vocabulary, which needs the whole corpus"
+
+        ngrams = set()
+        if isinstance(X, EncodedMessages):
+            for _, _, distinct_ngrams in self._encoded_ngrams(X):
+                ngrams.update(distinct_ngrams)
+        else:
+            for message in X:
+                ngrams.update(self._ngrams(self.retrieve_lexical_form(message)))
+
+        if not hasattr(self, "vocabulary_"):
+            self._set_vocabulary(ngrams)
+        else:
+            self._extend_vocabulary(ngrams)
+        return self
 
     def get_feature_names(self):
+        if self.n_features is not None:
+            raise AttributeError("No feature names, ngrams are hashed")
+
+        if getattr(self, "_feature_table", None) is not None:
+            sorted_names, name_lengths, columns = self._feature_table
+            order = np.argsort(columns)
+            # Trailing NUL bytes dropped by numpy byte strings are restored from the length of each name
+            return [name.ljust(length, b"\x00").decode("utf-8", "surrogatepass")
+                    for name, length in zip(sorted_names[order].tolist(), name_lengths[order].tolist())]
+
+        if self.engine == "csr":
+            if not hasattr(self, "feature_names_"):
+                raise AttributeError("No feature names, object has not been fitted")
+            return list(self.feature_names_)
+
         try:
+            if hasattr(self.vectorizer, "get_feature_names_out"):
+                return list(self.vectorizer.get_feature_names_out())
             return self.vectorizer.get_feature_names()
         except AttributeError:
             raise AttributeError("No feature names, object has not been fitted")
 
+    def save(self, path):
+        """
+        Saves a fitted extractor to a directory, which load can memory-map. Only what transform needs is saved:
+        the parameters, the feature names as a sorted array with their lengths and, if a form is used, the form of each word in the
+        lexicon, but not the lexicon itself. default_form must be a module-level function, saved by name.
+        The directory is created if it does not exist.
+        :type path: str
+        """
+        default_form = "{}:{}".format(self.default_form.__module__, self.default_form.__qualname__)
+        assert "<" not in default_form, "default_form must be a module-level function to be saved, not {}".format(
+            default_form)
+
+        params = self.get_params(deep=False)
+        del params["lexicon"], params["default_form"]
+        params["dtype"] = np.dtype(self.dtype).name
+        arrays = {}
+
+        if self.n_features is None:
+            names = [name.encode("utf-8", "surrogatepass") for name in self.get_feature_names()]
+            name_lengths = np.fromiter(map(len, names), dtype=np.int64, count=len(names))
+            names = np.array(names, dtype="S{}".format(max(name_lengths, default=1)))
+            order = np.argsort(names, kind="stable")
+            arrays["feature_names"] = names[order]
+            arrays["feature_name_lengths"] = name_lengths[order]
+            arrays["feature_columns"] = order.astype(np.int64)
+
+        if self.form is not None:
+            forms = Vocabulary()
+            form_table = self._get_form_table()
+            arrays["form_words"], arrays["form_word_offsets"] = Vocabulary(form_table.keys()).to_arrays()
+            arrays["form_ids"] = forms.encode(form_table.values())
+            arrays["forms"], arrays["form_offsets"] = forms.to_arrays()
+
+        os.makedirs(path, exist_ok=True)
+        for name, values in arrays.items():
+            np.save(os.path.join(path, name + ".npy"), values)
+        with open(os.path.join(path, "extractor.json"), "w") as f:
+            json.dump({"format_version": self.FORMAT_VERSION, "params": params, "default_form": default_form}, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Loads an extractor saved with save, ready to transform messages. It has no lexicon: forms of words are looked up
+        in the saved forms, and default_form is called with None as the lexicon for other words.
+        :param mmap: whether to memory-map the feature names rather than read them into memory, so that they are
+                     shared through the page cache by every process which loads the same extractor
+        :type mmap: bool
+        :rtype: NGramFrequencyExtractor
+        """
+        with open(os.path.join(path, "extractor.json")) as f:
+            header = json.load(f)
+        assert header["format_version"] == cls.FORMAT_VERSION, \
+            "Unsupported extractor format version {}".format(header["format_version"])
+
+        def load_array(name, mmap_mode=None):
+            return np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+
+        module, qualname = header["default_form"].split(":")
+        default_form = importlib.import_module(module)
+        for name in qualname.split("."):
+            default_form = getattr(default_form, name)
+
+        params = header["params"]
+        if params["ngram_range"] is not None:
+            params["ngram_range"] = tuple(params["ngram_range"])
+        params["dtype"] = np.dtype(params["dtype"]).type
+        extractor = cls(None, default_form=default_form, **params)
+
+        if extractor.n_features is None:
+            extractor._feature_table = (load_array("feature_names", "r" if mmap else None),
+                                        load_array("feature_name_lengths", "r" if mmap else None),
+                                        load_array("feature_columns", "r" if mmap else None))
+
+        if extractor.form is not None:
+            words = Vocabulary.from_arrays(load_array("form_words"), load_array("form_word_offsets"))
+            forms = Vocabulary.from_arrays(load_array("forms"), load_array("form_offsets"))
+            extractor._form_table = dict(zip(words.get_tokens(), forms.decode(load_array("form_ids"))))
+            extractor._default_forms = {}
+
+        return extractor
+
+    def _look_up_feature_table(self, ngrams):
+        """
+        :return: the column of each ngram in the feature table of a loaded extractor (-1 if not in it) and the value
+                 each occurrence adds
+        :rtype: (np.array, np.array)
+        """
+        sorted_names, name_lengths, columns = self._feature_table
+        found_columns = np.full(len(ngrams), -1, dtype=np.int64)
+        if len(sorted_names) == 0:
+            return found_columns, np.ones(len(ngrams))
+
+        names = [",".join(ngram).encode("utf-8", "surrogatepass") for ngram in ngrams]
+        lengths = np.fromiter(map(len, names), dtype=np.int64, count=len(names))
+        # Names are compared as numpy byte strings, which drop trailing NUL bytes and truncate names longer than
+        # those in the table, so a name only matches an equal one of the same length
+        names = np.array(names, dtype=sorted_names.dtype)
+        starts = np.searchsorted(sorted_names, names, side="left")
+        ends = np.searchsorted(sorted_names, names, side="right")
+
+        positions = np.minimum(starts, len(sorted_names) - 1)
+        found = (ends - starts == 1) & (name_lengths[positions] == lengths)
+        found_columns[found] = columns[positions[found]]
+
+        # Several names of the table only compare equal if they differ by trailing NULs, which is rare
+        for i in np.flatnonzero(ends - starts > 1).tolist():
+            matches = np.flatnonzero(name_lengths[starts[i]:ends[i]] == lengths[i])
+            if len(matches) > 0:
+                found_columns[i] = columns[starts[i] + matches[0]]
+
+        return found_columns, np.ones(len(ngrams))
+
+    def _ngrams(self, tokens):
+        """
+        Generates the ngram tuples of every size in the ngram range from a list of tokens.
+        Within each size, ngrams are generated in the same order as by nltk.ngrams.
+        """
+        min_n, max_n = self._get_ngram_range()
+        if min_n == max_n:
+            return zip(*(tokens[i:] for i in range(min_n)))
+
+        return itertools.chain.from_iterable(zip(*(tokens[i:] for i in range(n))) for n in range(min_n, max_n + 1))
+
+    def _get_ngram_range(self):
+        if self.ngram_range is None:
+            return self.ngram_size, self.ngram_size
+
+        min_n, max_n = self.ngram_range
+        assert 1 <= min_n <= max_n, "Invalid ngram range {}".format(self.ngram_range)
+        return min_n, max_n
+
+    def _is_pruning(self):
+        # An int max_df of 1 is a number of messages, unlike the default float max_df of 1.0, and conversely for min_df
+        return (not isinstance(self.min_df, numbers.Integral) or self.min_df > 1 or
+                isinstance(self.max_df, numbers.Integral) or self.max_df < 1.0 or self.max_features is not None)
+
+    def _find_frequent_ngrams(self, X):
+        """
+        Finds the ngrams to keep in the vocabulary according to min_df, max_df and max_features, in two passes over X.
+        The first pass estimates the document frequency of each ngram with a count-min sketch, and ngrams only become
+        candidates for the vocabulary once their estimate reaches min_df, if it is an int. Candidates are then counted
+        exactly. With max_features, candidates are regularly cut down to those counted in the most messages (heavy
+        hitters); the sketch keeps counting those which are dropped, so they come back if they turn out to be
+        frequent. The second pass counts the document frequencies of the remaining candidates exactly, to decide
+        which are kept.
+        :param X: tokenised messages, iterated over twice
+        :type X: iterable of list(str) | EncodedMessages
+        :rtype: list(tuple(str))
+        """
+        sketch = _CountMinSketch(self._get_sketch_width(X), self.SKETCH_DEPTH)
+        admission_count = self.min_df if isinstance(self.min_df, numbers.Integral) else 1
+        max_candidates = None
+        if self.max_features is not None:
+            max_candidates = self.HEAVY_HITTERS_FACTOR * max(self.max_features, 1)
+
+        candidates = {}     # ngram -> ngram joined into a feature name
+        candidate_counts = {}   # feature name -> number of messages it was counted in since becoming a candidate
+        n_messages = 0
+        for chunk in iter_chunks(X, self.CHUNK_SIZE):
+            n_messages += len(chunk)
+
+            # Each feature name is counted once per message it appears in
+            names = []
+            ngrams = []
+            for message in chunk:
+                message_ngrams = {",".join(ngram): ngram for ngram in self._ngrams(self.retrieve_lexical_form(message))}
+                names.extend(message_ngrams.keys())
+                ngrams.extend(message_ngrams.values())
+
+            estimates = sketch.add(names)
+            for i in np.flatnonzero(estimates >= admission_count).tolist():
+                candidates[ngrams[i]] = names[i]
+                candidate_counts[names[i]] = candidate_counts.get(names[i], 0) + 1
+
+            if max_candidates is not None and len(candidates) > max_candidates:
+                candidates = _most_frequent(candidates, candidate_counts, 2 * self.max_features)
+                candidate_counts = {name: candidate_counts[name] for name in set(candidates.values())}
+
+        if isinstance(self.min_df, numbers.Integral):
+            min_count = self.min_df
+        else:
+            min_count = math.ceil(self.min_df * n_messages)
+        if isinstance(self.max_df, numbers.Integral):
+            max_count = self.max_df
+        else:
+            max_count = self.max_df * n_messages
+
+        document_frequencies = self._count_document_frequencies(X, set(candidates.values()))
+        candidates = {ngram: name for ngram, name in candidates.items()
+                      if min_count <= document_frequencies[name] <= max_count}
+        if self.max_features is not None:
+            candidates = _most_frequent(candidates, document_frequencies, self.max_features)
+
+        return list(candidates)
+
+    def _get_sketch_width(self, X):
+        """
+        :return: number of counters in each row of the sketch of document frequencies, growing with the number of
+                 messages when it is known so that the sketch does not saturate on large corpora
+        :rtype: int
+        """
+        try:
+            n_messages = len(X)
+        except TypeError:
+            return self.SKETCH_WIDTH
+
+        width = 2 ** math.ceil(math.log2(max(n_messages * self.SKETCH_COUNTERS_PER_MESSAGE, 1)))
+        return min(max(width, self.SKETCH_WIDTH), max(self.MAX_SKETCH_WIDTH, self.SKETCH_WIDTH))
+
+    def _count_document_frequencies(self, X, names):
+        """
+        :param X: tokenised messages
+        :type X: iterable of list(str) | EncodedMessages
+        :param names: feature names to count
+        :type names: set(str)
+        :return: exact number of messages each feature name appears in
+        :rtype: dict(str, int)
+        """
+        document_frequencies = dict.fromkeys(names, 0)
+        for message in X:
+            for name in {",".join(ngram) for ngram in self._ngrams(self.retrieve_lexical_form(message))}:
+                if name in document_frequencies:
+                    document_frequencies[name] += 1
+        return document_frequencies
+
+    def _set_vocabulary(self, ngrams):
+        """
+        Builds the feature names and the ngram -> column mapping.
+        Features are named and ordered in the same way as by the DictVectorizer: ngrams joined by "," and sorted.
+        """
+        joined_ngrams = {ngram: ",".join(ngram) for ngram in ngrams}
+        self.feature_names_ = sorted(set(joined_ngrams.values()))
+        columns = {name: column for column, name in enumerate(self.feature_names_)}
+        self.vocabulary_ = {ngram: columns[name] for ngram, name in joined_ngrams.items()}
+
+    def _extend_vocabulary(self, ngrams):
+        """
+        Adds the ngrams not already in the vocabulary, giving those with new joined strings new columns in sorted order
+        """
+        columns = {name: column for column, name in enumerate(self.feature_names_)}
+        new_ngrams = {ngram: ",".join(ngram) for ngram in ngrams if ngram not in self.vocabulary_}
+        for name in sorted(set(new_ngrams.values()) - columns.keys()):
+            columns[name] = len(self.feature_names_)
+            self.feature_names_.append(name)
+        for ngram, name in new_ngrams.items():
+            self.vocabulary_[ngram] = columns[name]
+
+    def _hash_matrix(self, X):
+        """
+        Builds the frequency matrix by hashing the ngrams of each message into n_features columns
+        :rtype: scipy.sparse.csr_matrix
+        """
+        ngram_counts = array("d")
+
+        def message_ngrams():
+            for message in X:
+                ngrams = [",".join(ngram) for ngram in self._ngrams(self.retrieve_lexical_form(message))]
+                ngram_counts.append(len(ngrams))
+                yield ngrams
+
+        hasher = FeatureHasher(n_features=self.n_features, input_type="string", alternate_sign=self.alternate_sign,
+                               dtype=self.dtype)
+        matrix = hasher.transform(message_ngrams())
+        return self._normalise(matrix, ngram_counts)
+
+    def _encoded_ngrams(self, X):
+        """
+        Finds the ngrams of encoded messages with array operations, per ngram size.
+        Tokens are mapped onto their lexical form once per distinct token id rather than once per occurrence.
+        :type X: EncodedMessages
+        :return: for each ngram size, the message index of each ngram occurrence, the index of each occurrence's ngram
+                 in the list of distinct ngrams, and the list of distinct ngrams as tuples of lexical forms
+        :rtype: generator of (np.array, np.array, list(tuple(str)))
+        """
+        present_ids = np.unique(X.ids)
+        forms = Vocabulary()
+        form_ids = np.zeros(len(X.vocabulary), dtype=X.ids.dtype)
+        form_ids[present_ids] = forms.encode(self.retrieve_lexical_form(X.vocabulary.decode(present_ids)))
+        form_ids = form_ids[X.ids]
+        form_tokens = np.empty(len(forms), dtype=object)
+        form_tokens[:] = forms.get_tokens()
+
+        min_n, max_n = self._get_ngram_range()
+        for n in range(min_n, max_n + 1):
+            rows, inverse, positions = _find_encoded_ngrams(form_ids, X.offsets, n)
+            # Tuples are assembled column by column so that no Python code runs per ngram
+            distinct_ngrams = list(zip(*(form_tokens[form_ids[positions + i]] for i in range(n))))
+            yield rows, inverse, distinct_ngrams
+
+    def _look_up_ngrams(self, ngrams):
+        """
+        :return: the column of each ngram in the fitted vocabulary (-1 if not in it) and the value each occurrence adds
+        :rtype: (np.array, np.array)
+        """
+        vocabulary = self.vocabulary_
+        columns = np.fromiter((vocabulary.get(ngram, -1) for ngram in ngrams), dtype=np.int64, count=len(ngrams))
+        return columns, np.ones(len(ngrams))
+
+    def _hash_ngrams(self, ngrams):
+        """
+        :return: the hashed column of each ngram and the value each occurrence adds, computed in the same way as by
+                 the FeatureHasher
+        :rtype: (np.array, np.array)
+        """
+        return _hash_strings([",".join(ngram) for ngram in ngrams], self.n_features, self.alternate_sign)
+
+    def _build_encoded_matrix(self, X, encoded_ngrams, ngram_columns, n_features):
+        """
+        Builds the frequency matrix of encoded messages with array operations
+        :type X: EncodedMessages
+        :param encoded_ngrams: ngrams of X, as generated by _encoded_ngrams
+        :param ngram_columns: function mapping a list of distinct ngrams onto their columns (-1 to ignore an ngram)
+                              and the values their occurrences add to them
+        :type ngram_columns: function
+        :rtype: scipy.sparse.csr_matrix
+        """
+        all_rows = []
+        all_columns = []
+        all_values = []
+        for rows, inverse, distinct_ngrams in encoded_ngrams:
+            columns, values = ngram_columns(distinct_ngrams)
+            columns = columns[inverse]
+            found = columns >= 0
+            all_rows.append(rows[found])
+            all_columns.append(columns[found])
+            all_values.append(values[inverse][found])
+
+        # Occurrences of the same ngram in a message are summed when converting to CSR
+        matrix = sp.coo_matrix((np.concatenate(all_values), (np.concatenate(all_rows), np.concatenate(all_columns))),
+                               shape=(len(X), n_features)).tocsr()
+
+        min_n, max_n = self._get_ngram_range()
+        lengths = X.get_lengths()
+        ngram_counts = sum(np.maximum(lengths - n + 1, 0) for n in range(min_n, max_n + 1))
+        return self._normalise(matrix, ngram_counts)
+
+    def _normalise(self, matrix, ngram_counts):
+        """
+        Converts a matrix of ngram counts to dtype, and adjusts its rows for message length and norm as configured
+        :param ngram_counts: number of ngrams in each message, including those not in the matrix
+        :type ngram_counts: np.array | array
+        :rtype: scipy.sparse.csr_matrix
+        """
+        return _normalise_rows(matrix, ngram_counts, self.dtype, self.adjust_for_message_len, self.norm)
+
+    def _build_matrix(self, X, vocabulary, grow=False):
+        """
+        Builds the matrix of ngram counts directly from the CSR arrays, counting ngram columns per message.
+        :param vocabulary: ngram tuple -> column mapping. ngrams which are not in the vocabulary are ignored,
+                           unless grow is True, in which case they are added to it with the next free column.
+        :type vocabulary: dict
+        :return: the matrix, and the number of ngrams in each message including those not in the vocabulary
+        :rtype: (scipy.sparse.csr_matrix, np.array)
+        """
+        data = array("d")
+        indices = array("i")
+        indptr = array("q", [0])
+        ngram_counts = array("d")
+
+        for message in X:
+            ngram_count = 0
+            column_counts = {}
+            for ngram in self._ngrams(self.retrieve_lexical_form(message)):
+                ngram_count += 1
+                column = vocabulary.get(ngram)
+                if column is None:
+                    if not grow:
+                        continue
+                    column = vocabulary[ngram] = len(vocabulary)
+                column_counts[column] = column_counts.get(column, 0) + 1
+
+            columns = sorted(column_counts)
+            indices.extend(columns)
+            data.extend(column_counts[column] for column in columns)
+            indptr.append(len(indices))
+            ngram_counts.append(ngram_count)
+
+        n_features = len(vocabulary) if grow else len(self.feature_names_)
+        matrix = sp.csr_matrix((np.frombuffer(data, dtype=np.float64), np.frombuffer(indices, dtype=np.intc),
+                                np.frombuffer(indptr, dtype=np.int64)),
+                               shape=(len(indptr) - 1, n_features))
+        return matrix, np.frombuffer(ngram_counts, dtype=np.float64)
+
     def retrieve_lexical_form(self, message):
         if self.form is None:
             return message
 
-        assert self.lexicon.has_feature(self.form)
+        form_table = self._get_form_table()
+        default_forms = self._default_forms
 
         transformed_message = []
         for word in message:
-            if word in self.lexicon and self.lexicon.get_feature_value_by_word(word, self.form):
-                transformed_message.append(self.lexicon.get_feature_value_by_word(word, self.form))
-            else:
-                transformed_message.append(self.default_form(word, self.lexicon))
+            form = form_table.get(word)
+            if form is None:
+                form = default_forms.get(word)
+                if form is None:
+                    if len(default_forms) >= self.MAX_DEFAULT_FORMS:
+                        default_forms.clear()
+                    form = default_forms[word] = self.default_form(word, self.lexicon)
+            transformed_message.append(form)
 
         return transformed_message
 
+    def _get_form_table(self):
+        """
+        Compiles the lookup table of the lexical forms of words in the lexicon, once per lexicon, form and
+        modification of the lexicon. Forms computed with default_form for other words are memoised alongside it
+        in _default_forms, so default_form must always return the same form for the same word and lexicon.
+        :return: word -> lexical form, for words whose form in the lexicon is set
+        :rtype: dict(str, str)
+        """
+        if self.lexicon is None:
+            # Loaded extractors keep the table they were saved with
+            return self._form_table
+
+        key = (self.lexicon, self.form, self.lexicon.get_version())
+        cached_key = getattr(self, "_form_table_key", None)
+        if cached_key is None or cached_key[0] is not key[0] or cached_key[1:] != key[1:]:
+            assert self.lexicon.has_feature(self.form)
+
+            self._form_table = {word: form for word, form in self.lexicon.get_feature_values_by_word(self.form).items()
+                                if form}
+            self._default_forms = {}
+            self._form_table_key = key
+
+        return self._form_table
+
+class TextNGramFrequencyExtractor(NGramFrequencyExtractor):
+    """
+    Transformer object turning raw message strings into frequency feature vectors in a single streaming pass:
+    each message is tokenised, mapped onto its lexical form and has its ngrams counted into the sparse matrix before
+    the next one is read, so no tokenised copy of the corpus is held in memory.
+    Output is identical to a Tokeniser followed by an NGramFrequencyExtractor with the same parameters, which are
+    described in NGramFrequencyExtractor. When deduplicating, identical raw messages are only processed once.
+    Sci-kit learn documentation on creating estimators: http://scikit-learn.org/dev/developers/contributing.html#rolling-your-own-estimator
+    """
+
+    def extract_frequency_dicts(self, X):
+        if self.deduplicate:
+            unique_X, inverse = _deduplicate(X)
+            frequency_dicts = self._extract_frequency_dicts(_tokenise_messages(unique_X))
+            return [frequency_dicts[i] for i in inverse]
+
+        return self._extract_frequency_dicts(_tokenise_messages(X))
+
+    def fit(self, X, y=None):
+        """
+        Determines the list of tokens and ngrams to be used
+        :param X: raw messages
+        :type X: iterable of str
+        """
+        if self._is_pruning():
+            assert iter(X) is not X, \
+                "Pruning the vocabulary reads the messages twice, so they must be re-iterable (e.g. a list), " \
+                "not an iterator"
+            # Messages are tokenised again on each pass rather than held in memory tokenised
+            return super().fit(_TokenisedMessages(X))
+
+        if self.deduplicate:
+            X, _ = _deduplicate(X)
+
+        return super().fit(_tokenise_messages(X))
+
+    def transform(self, X, y=None):
+        """
+        Transforms raw messages into frequency vectors
+        :type X: iterable of str
+        :rtype: scipy.sparse.csr_matrix
+        """
+        if self.deduplicate:
+            unique_X, inverse = _deduplicate(X)
+            return self._transform(_tokenise_messages(unique_X))[inverse]
+
+        return self._transform(_tokenise_messages(X))
+
+    def fit_transform(self, X, y=None, **fit_params):
+        """
+        Fit to raw messages then transform them
+        :type X: list(str)
+        :rtype: scipy.sparse.csr_matrix
+        """
+        if self._is_pruning():
+            # X must be re-iterable, which fit checks
+            return self.fit(X).transform(X)
+
+        if self.deduplicate:
+            unique_X, inverse = _deduplicate(X)
+            return self._fit_transform(_tokenise_messages(unique_X))[inverse]
+
+        return self._fit_transform(_tokenise_messages(X))
+
+    def partial_fit(self, X, y=None):
+        """
+        Fits on a batch of raw messages, as NGramFrequencyExtractor.partial_fit
+        :type X: iterable of str
+        """
+        return super().partial_fit(_tokenise_messages(X))
+
+class CharNGramFrequencyExtractor(BaseEstimator, TransformerMixin):
+    """
+    Transformer object turning raw messages into frequency feature vectors counting character ngrams, which are less
+    affected than words by misspellings and by messages mixing languages.
+    Messages are processed in chunks as arrays of Unicode code points, so ngrams are found and counted with array
+    operations rather than by slicing strings, and only distinct ngrams are turned into str.
+    Sci-kit learn documentation on creating estimators: http://scikit-learn.org/dev/developers/contributing.html#rolling-your-own-estimator
+    """
+    def __init__(self, ngram_range=(2, 5), adjust_for_message_len=True, n_features=None, alternate_sign=True,
+                 dtype=np.float64, norm=None, chunk_size=10000):
+        """
+        :param ngram_range: (min_n, max_n) to count character ngrams of every size from min_n to max_n inclusive.
+                            When adjusting for message length, frequencies are relative to the total number of ngrams
+                            of all sizes in the message.
+        :type ngram_range: (int, int)
+        :param n_features: if set, ngrams are hashed into this many columns instead of being looked up in a fitted
+                           vocabulary, as in NGramFrequencyExtractor
+        :type n_features: int | None
+        :param alternate_sign: in hashing mode, whether the sign of each hashed value is also determined by the hash
+        :type alternate_sign: bool
+        :param dtype: type of the values of the frequency matrix
+        :type dtype: type
+        :param norm: "l1" or "l2" to scale each row of the frequency matrix to unit norm, or None
+        :type norm: str | None
+        :param chunk_size: number of messages converted to code points and counted at a time
+        :type chunk_size: int
+        """
+        assert norm in NGramFrequencyExtractor.NORMS, \
+            "Invalid norm '{}', must be one of {}".format(norm, NGramFrequencyExtractor.NORMS)
+
+        self.ngram_range = ngram_range
+        self.adjust_for_message_len = adjust_for_message_len
+        self.n_features = n_features
+        self.alternate_sign = alternate_sign
+        self.dtype = dtype
+        self.norm = norm
+        self.chunk_size = chunk_size
+
+    def fit(self, X, y=None):
+        """
+        Determines the list of character ngrams to be used
+        :param X: raw messages
+        :type X: iterable of str
+        """
+        if self.n_features is not None:
+            return self
+
+        ngrams = set()
+        for chunk in iter_chunks(X, self.chunk_size):
+            for _, _, distinct_ngrams in self._chunk_ngrams(chunk):
+                ngrams.update(distinct_ngrams)
+        self._set_vocabulary(ngrams)
+        return self
+
+    def partial_fit(self, X, y=None):
+        """
+        Fits on a batch of raw messages. ngrams not seen in earlier batches are added to the vocabulary as new columns
+        after the existing ones, so the columns of ngrams already seen do not change between batches.
+        :type X: iterable of str
+        """
+        if self.n_features is not None:
+            return self
+
+        if not hasattr(self, "vocabulary_"):
+            return self.fit(X)
+
+        for chunk in iter_chunks(X, self.chunk_size):
+            for _, _, distinct_ngrams in self._chunk_ngrams(chunk):
+                for ngram in distinct_ngrams:
+                    if ngram not in self.vocabulary_:
+                        self.vocabulary_[ngram] = len(self.feature_names_)
+                        self.feature_names_.append(ngram)
+        return self
+
+    def transform(self, X, y=None):
+        """
+        Transforms raw messages into frequency vectors
+        :type X: iterable of str
+        :rtype: scipy.sparse.csr_matrix
+        """
+        if self.n_features is not None:
+            matrix, ngram_counts = self._count(X, self._hash_ngrams, self.n_features)
+        else:
+            if not hasattr(self, "vocabulary_"):
+                raise AttributeError("No vocabulary, object has not been fitted")
+            matrix, ngram_counts = self._count(X, self._look_up_ngrams, len(self.feature_names_))
+
+        return _normalise_rows(matrix, ngram_counts, self.dtype, self.adjust_for_message_len, self.norm)
+
+    def fit_transform(self, X, y=None, **fit_params):
+        """
+        Fit to raw messages then transform them, in a single pass
+        :type X: iterable of str
+        :rtype: scipy.sparse.csr_matrix
+        """
+        if self.n_features is not None:
+            return self.transform(X)
+
+        # Columns are numbered in order of first appearance while counting, then renumbered into sorted order
+        provisional_vocabulary = {}
+
+        def add_ngrams(ngrams):
+            columns = np.fromiter((provisional_vocabulary.setdefault(ngram, len(provisional_vocabulary))
+                                   for ngram in ngrams), dtype=np.int64, count=len(ngrams))
+            return columns, np.ones(len(ngrams))
+
+        matrix, ngram_counts = self._count(X, add_ngrams, None)
+        self._set_vocabulary(provisional_vocabulary)
+        permutation = np.fromiter((self.vocabulary_[ngram] for ngram in provisional_vocabulary), dtype=np.int64,
+                                  count=len(provisional_vocabulary))
+        matrix = sp.csr_matrix((matrix.data, permutation[matrix.indices], matrix.indptr),
+                               shape=(matrix.shape[0], len(self.feature_names_)))
+        matrix.sort_indices()
+
+        return _normalise_rows(matrix, ngram_counts, self.dtype, self.adjust_for_message_len, self.norm)
+
+    def get_feature_names(self):
+        if self.n_features is not None:
+            raise AttributeError("No feature names, ngrams are hashed")
+        if not hasattr(self, "feature_names_"):
+            raise AttributeError("No feature names, object has not been fitted")
+        return list(self.feature_names_)
+
+    def _set_vocabulary(self, ngrams):
+        self.feature_names_ = sorted(ngrams)
+        self.vocabulary_ = {ngram: column for column, ngram in enumerate(self.feature_names_)}
+
+    def _look_up_ngrams(self, ngrams):
+        vocabulary = self.vocabulary_
+        columns = np.fromiter((vocabulary.get(ngram, -1) for ngram in ngrams), dtype=np.int64, count=len(ngrams))
+        return columns, np.ones(len(ngrams))
+
+    def _hash_ngrams(self, ngrams):
+        return _hash_strings(ngrams, self.n_features, self.alternate_sign)
+
+    def _chunk_ngrams(self, messages):
+        """
+        Finds the character ngrams of a chunk of messages with array operations, per ngram size
+        :type messages: list(str)
+        :return: for each ngram size, the message index of each ngram occurrence, the index of each occurrence's ngram
+                 in the list of distinct ngrams, and the list of distinct ngrams
+        :rtype: generator of (np.array, np.array, list(str))
+        """
+        min_n, max_n = self.ngram_range
+        assert 1 <= min_n <= max_n, "Invalid ngram range {}".format(self.ngram_range)
+
+        # UTF-32 has one code unit per character, so message i is code_points[offsets[i]:offsets[i + 1]]
+        # surrogatepass keeps lone surrogates, which are valid in a str, as their own code points
+        code_points = np.frombuffer("".join(messages).encode("utf-32-le", "surrogatepass"), dtype="<u4")
+        offsets = np.zeros(len(messages) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, messages), dtype=np.int64, count=len(messages)), out=offsets[1:])
+
+        for n in range(min_n, max_n + 1):
+            rows, inverse, positions = _find_encoded_ngrams(code_points, offsets, n)
+            # The code points of the distinct ngrams are gathered and decoded at once, then split every n characters.
+            # Unlike viewing them as fixed-width numpy strings, this keeps trailing NUL characters.
+            distinct_text = code_points[positions[:, np.newaxis] + np.arange(n)].tobytes().decode("utf-32-le",
+                                                                                                  "surrogatepass")
+            yield rows, inverse, [distinct_text[i:i + n] for i in range(0, len(distinct_text), n)]
+
+    def _count(self, X, ngram_columns, n_features):
+        """
+        Counts the character ngrams of each message, chunk by chunk
+        :param ngram_columns: function mapping a list of distinct ngrams onto their columns (-1 to ignore an ngram)
+                              and the values their occurrences add to them
+        :type ngram_columns: function
+        :param n_features: number of columns, or None if ngram_columns adds columns as it goes
+        :type n_features: int | None
+        :return: matrix of ngram counts, and the number of ngrams of all sizes in each message
+        :rtype: (scipy.sparse.csr_matrix, np.array)
+        """
+        min_n, max_n = self.ngram_range
+        data, indices, indptr, ngram_counts = [], [], [np.zeros(1, dtype=np.int64)], []
+        max_column = -1
+        for chunk in iter_chunks(X, self.chunk_size):
+            all_rows, all_columns, all_values = [], [], []
+            for rows, inverse, distinct_ngrams in self._chunk_ngrams(chunk):
+                columns, values = ngram_columns(distinct_ngrams)
+                columns = columns[inverse]
+                found = columns >= 0
+                all_rows.append(rows[found])
+                all_columns.append(columns[found])
+                all_values.append(values[inverse][found])
+
+            columns = np.concatenate(all_columns)
+            max_column = max(max_column, int(columns.max(initial=-1)))
+            # Occurrences of the same ngram in a message are summed when converting to CSR
+            chunk_matrix = sp.coo_matrix((np.concatenate(all_values), (np.concatenate(all_rows), columns)),
+                                         shape=(len(chunk), max_column + 1)).tocsr()
+            data.append(chunk_matrix.data)
+            indices.append(chunk_matrix.indices)
+            indptr.append(chunk_matrix.indptr[1:] + indptr[-1][-1])
+
+            lengths = np.fromiter(map(len, chunk), dtype=np.int64, count=len(chunk))
+            ngram_counts.append(sum(np.maximum(lengths - n + 1, 0) for n in range(min_n, max_n + 1)))
+
+        n_rows = sum(map(len, ngram_counts))
+        matrix = sp.csr_matrix((np.concatenate(data) if data else np.zeros(0),
+                                np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32),
+                                np.concatenate(indptr)),
+                               shape=(n_rows, max_column + 1 if n_features is None else n_features))
+        return matrix, np.concatenate(ngram_counts) if ngram_counts else np.zeros(0)
+
+def _tokenise_messages(messages):
+    """
+    :return: tokenised messages, tokenised lazily
+    :rtype: generator of list of str
+    """
+    return (_tokenise(message) for message in messages)
+
+class _TokenisedMessages:
+    """
+    Raw messages tokenised lazily each time they are iterated over, so that they can be read more than once without
+    holding them in memory tokenised
+    """
+    def __init__(self, messages):
+        self.messages = messages
+
+    def __iter__(self):
+        return _tokenise_messages(self.messages)
+
+    def __len__(self):
+        return len(self.messages)
+
+class _CountMinSketch:
+    """
+    Count-min sketch with conservative update, approximately counting str items in fixed memory. Each item is counted
+    in one counter per row, chosen by hashing, and its count is estimated by the smallest of its counters, which can
+    only be too high.
+    With width w and depth d, an estimate exceeds the true count by more than e/w times the total count with
+    probability at most exp(-d).
+    :ivar counts: counters, of shape (depth, width)
+    :type counts: np.array
+    """
+    def __init__(self, width, depth):
+        self.counts = np.zeros((depth, width), dtype=np.int32)
+
+    def _get_columns(self, items):
+        """
+        :return: the counter of each item in each row, of shape (depth, number of items)
+        :rtype: np.array
+        """
+        # The counters of all rows are derived from two hashes (double hashing) of the UTF-8 bytes of each item
+        items = [item.encode("utf-8", "surrogatepass") for item in items]
+        first_hashes = np.fromiter((murmurhash3_32(item, seed=0, positive=True) for item in items), dtype=np.int64,
+                                   count=len(items))
+        second_hashes = np.fromiter((murmurhash3_32(item, seed=1, positive=True) for item in items), dtype=np.int64,
+                                    count=len(items))
+        rows = np.arange(self.counts.shape[0])[:, np.newaxis]
+        return (first_hashes + rows * second_hashes) % self.counts.shape[1]
+
+    def _estimate(self, columns):
+        return self.counts[np.arange(self.counts.shape[0])[:, np.newaxis], columns].min(axis=0)
+
+    def add(self, items):
+        """
+        Counts each item once per occurrence in items, with conservative update: the counters of an item are only
+        raised as far as its new estimate, rather than all incremented. Estimates can still only be too high, but
+        are much closer to the true counts of rare items when many items share counters.
+        :type items: list(str)
+        :return: estimated count of each item, including these occurrences
+        :rtype: np.array
+        """
+        # Occurrences of the same item are added at once
+        item_indexes = {}
+        inverse = np.fromiter((item_indexes.setdefault(item, len(item_indexes)) for item in items), dtype=np.int64,
+                              count=len(items))
+        columns = self._get_columns(list(item_indexes))
+        estimates = self._estimate(columns) + np.bincount(inverse, minlength=len(item_indexes))
+        np.maximum.at(self.counts, (np.arange(self.counts.shape[0])[:, np.newaxis], columns),
+                      estimates.astype(self.counts.dtype))
+        return estimates[inverse]
+
+def _most_frequent(candidates, counts, n):
+    """
+    :param candidates: ngram -> feature name
+    :type candidates: dict(tuple(str), str)
+    :param counts: number of messages each feature name was counted in
+    :type counts: dict(str, int)
+    :param n: number of feature names to keep
+    :type n: int
+    :return: the candidates with the n feature names in most messages, ties going to the first names in sorted order
+    :rtype: dict(tuple(str), str)
+    """
+    names = sorted(set(candidates.values()))
+    kept_names = set(sorted(names, key=lambda name: -counts[name])[:n])
+    return {ngram: name for ngram, name in candidates.items() if name in kept_names}
+
+def _deduplicate(items, key=None):
+    """
+    Finds the distinct items in a sequence
+    :param key: function making an item hashable, e.g. tuple for lists of tokens
+    :return: the distinct items in order of first appearance, and for each input item the index of its distinct item
+    :rtype: (list, np.array)
+    """
+    indices = {}
+    unique_items = []
+    inverse = []
+    for item in items:
+        item_key = item if key is None else key(item)
+        index = indices.get(item_key)
+        if index is None:
+            index = indices[item_key] = len(unique_items)
+            unique_items.append(item)
+        inverse.append(index)
+
+    return unique_items, np.array(inverse, dtype=np.intp)
+
+def _find_encoded_ngrams(ids, offsets, n):
+    """
+    Finds the ngrams of size n in ragged token id sequences, without crossing from one sequence to the next.
+    Distinct ngrams are identified by repeatedly pairing the id of each (k - 1)-gram with its next token id and
+    renumbering the pairs densely, so the keys never overflow whatever the value of n.
+    :type ids: np.array
+    :type offsets: np.array
+    :return: sequence index of each ngram occurrence, index of each occurrence's distinct ngram,
+             and position in ids of the first occurrence of each distinct ngram
+    :rtype: (np.array, np.array, np.array)
+    """
+    ngram_counts = np.maximum(np.diff(offsets) - n + 1, 0)
+    rows = np.repeat(np.arange(len(ngram_counts)), ngram_counts)
+    first_ngram_in_row = np.cumsum(ngram_counts) - ngram_counts
+    starts = offsets[:-1][rows] + np.arange(len(rows)) - first_ngram_in_row[rows]
+
+    n_ids = int(ids.max()) + 1 if len(ids) > 0 else 1
+    keys = ids[starts].astype(np.int64)
+    for i in range(1, n):
+        _, keys = np.unique(keys, return_inverse=True)
+        keys = keys.astype(np.int64) * n_ids + ids[starts + i]
+    _, first_positions, inverse = np.unique(keys, return_index=True, return_inverse=True)
+
+    return rows, inverse, starts[first_positions]
+
+def _hash_strings(strings, n_features, alternate_sign):
+    """
+    :return: the hashed column of each string and the value each occurrence adds, computed in the same way as by
+             the FeatureHasher. Strings are hashed as UTF-8 bytes, keeping lone surrogates which strict UTF-8 rejects.
+    :rtype: (np.array, np.array)
+    """
+    hashes = np.fromiter((murmurhash3_32(string.encode("utf-8", "surrogatepass"), seed=0) for string in strings),
+                         dtype=np.int64, count=len(strings))
+    values = np.where(hashes >= 0, 1.0, -1.0) if alternate_sign else np.ones(len(strings))
+    return np.abs(hashes) % n_features, values
+
+def _normalise_rows(matrix, ngram_counts, dtype, adjust_for_message_len, norm):
+    """
+    Converts a matrix of ngram counts to dtype, then scales its rows in place: dividing them by the number of ngrams
+    in each message if adjust_for_message_len, then to unit norm if norm is set
+    :type matrix: scipy.sparse.csr_matrix
+    :param ngram_counts: number of ngrams in each message, including those not in the matrix
+    :type ngram_counts: np.array | array
+    :rtype: scipy.sparse.csr_matrix
+    """
+    matrix = matrix.astype(dtype, copy=False)
+    if adjust_for_message_len:
+        _scale_rows(matrix, np.asarray(ngram_counts, dtype=np.float64))
+    if norm is not None:
+        normalize(matrix, norm=norm, copy=False)
+    return matrix
+
+def _scale_rows(matrix, divisors):
+    """
+    Divides each row of a CSR matrix in place by the corresponding divisor. Rows with a divisor of 0 are left as is.
+    :type matrix: scipy.sparse.csr_matrix
+    :type divisors: np.array
+    """
+    divisors = np.where(divisors == 0, 1, divisors)
+    matrix.data /= np.repeat(divisors, np.diff(matrix.indptr))
+
 class Debugger(BaseEstimator, TransformerMixin):
+    """
+    Deprecated: prints shapes to stdout. Use profiling.StageProfiler or profiling.profile_pipeline instead,
+    which record timings, throughput, output density and memory for every stage to a pluggable collector.
+    """
     def __init__(self, print_string):
+        warnings.warn("Debugger is deprecated, use profiling.StageProfiler instead", DeprecationWarning)
         self.print_string = print_string
 
     def transform(self, X):
@@ -1,86 +1,357 @@
+import json
+import os
+from array import array
+
+import numpy as np
+import scipy.sparse as sp
+
+from .parallel_utils import get_n_workers, iter_chunks, map_chunks_in_processes
+from .vocabulary import Vocabulary, EncodedMessages, ID_DTYPE, OFFSET_DTYPE
+
 class Lexicon:
     """
-    Object containing lexical information on all words in the dataset
-    :ivar _all_words: a list of all words in the dataset as Word objects
-    :type _all_words: list(Word)
-    :ivar _features: an index of linguistic features mapping onto words.
-                     One outer dictionary maps the type of linguistic feature (e.g. "pos_tag") to the relevant inner dictionary,
-                     and inner dictionaries map the feature value (e.g. "noun") to a list of Words that match the value
-                     e.g. {
-                               "pos_tag": {
-                                   "noun": [Word("I"), Word("apples")],
-                                   "verb": [Word("eat")]
-                               },
-                               "original_str": {
-                                   "I": [Word("I")],
-                                   "eat": [Word("eat")],
-                                   "apples": [Word("apples")]
-                               }
-                           }
-    :type _features: dict[str, dict[str, list(str)]]
+    Object containing lexical information on all words in the dataset.
+    Words, their linguistic features and the messages they appear in are all stored as flat arrays indexed by token id,
+    so that a lexicon can be saved to disk and memory-mapped back by many processes at once.
+    :ivar _vocabulary: ids of all tokens in stored messages. The words of the lexicon are a subset of these tokens.
+    :type _vocabulary: Vocabulary
+    :ivar _is_word: whether each token is a word of the lexicon (tokens past its end are not)
+    :type _is_word: bytearray
+    :ivar _feature_values: for each linguistic feature (e.g. "pos_tag"), the values it takes (e.g. "noun")
+    :type _feature_values: dict(str, Vocabulary)
+    :ivar _feature_columns: for each linguistic feature, the id in _feature_values of each token's value,
+                            or -1 if it has none (tokens past the end of the column have none)
+                            e.g. with tokens ["I", "eat", "apples"],
+                            _feature_values == {"pos_tag": Vocabulary(["noun", "verb"])}
+                            _feature_columns == {"pos_tag": array("i", [0, 1, 0])}
+    :type _feature_columns: dict(str, array)
+    :ivar _feature_indexes: inverse of _feature_columns, built when needed: for each feature, the tokens with each value
+                            in CSR form (indptr, token ids)
+    :type _feature_indexes: dict(str, (np.array, np.array))
+    :ivar _feature_bitsets: bitsets of the tokens with each value of each feature, built when needed by select_words:
+                            feature -> value id -> bits packed with np.packbits
+    :type _feature_bitsets: dict(str, dict(int, np.array))
+    :ivar _message_tokens: token ids of all stored messages, concatenated
+    :type _message_tokens: array
+    :ivar _message_offsets: start of each message in _message_tokens, followed by the total number of token ids
+    :type _message_offsets: array
+    :ivar _postings_indptr: inverted index of the messages each token appears in, in CSR form: the ids of the messages
+                            token i appears in are _postings[_postings_indptr[i]:_postings_indptr[i + 1]],
+                            sorted and without duplicates
+    :type _postings_indptr: np.array
+    :ivar _postings: message ids of the inverted index
+    :type _postings: np.array
+    :ivar _pending_postings: (token ids, message ids) pairs added since the inverted index was last built
+    :type _pending_postings: list((np.array, np.array))
+    :ivar _store_messages: whether messages are stored and indexed. If not, only _document_frequencies is kept about
+                           them.
+    :type _store_messages: bool
+    :ivar _document_frequencies: when messages are not stored, the number of messages each token appeared in
+                                 (tokens past its end appeared in none)
+    :type _document_frequencies: array
+    :ivar _version: number of modifications to the words and features of the lexicon, so that anything derived from
+                    them can tell when it is out of date
+    :type _version: int
+
+    After load, the arrays are read-only np.arrays (possibly memory-mapped) until the lexicon is modified.
     """
+    FORMAT_VERSION = 1
+    CHUNK_SIZE = 10000     # Number of messages read from an iterator at a time
 
-    class _Word:
+    def __init__(self, messages, features, store_messages=True):       # Lexicon constructor
         """
-        Word object containing its original form and messages which contain it, as well as any other defined linguistic features
-        :ivar _original_str: original form of the word
-        :type _original_str: str
-        :ivar _features: dictionary of the word's linguistic features and their values
-        :type _features: dict(str)
-        :ivar _messages: messages in which the word appears
-        :type _messages: list(list(str))
+        :param messages: tokenised messages, either as an iterable of lists of str (e.g. a list, or a generator
+                         reading them from files) or as EncodedMessages. More can be added later with update.
+        :type messages: iterable of list(str) | EncodedMessages
+        :param features: names of the linguistic features words can have (e.g. "pos_tag")
+        :type features: list(str)
+        :param store_messages: whether messages are stored and indexed by word. If not, only the document frequency
+                               of each word is kept, so that memory grows with the number of distinct tokens rather
+                               than with the size of the corpus, and the methods retrieving messages are unavailable.
+        :type store_messages: bool
         """
-        def __init__(self, original_str, features):     # _Word constructor
-            self._original_str = original_str
-            self._features = dict.fromkeys(features, None)
-            self._messages = []
+        assert not isinstance(messages, str), \
+            "Messages must be an iterable of lists of str representing tokens, or EncodedMessages"
+        assert isinstance(features, list), "Features must be in a list of str"
 
-        def get_original_str(self):
-            return self._original_str
+        self._vocabulary = Vocabulary()
+        self._is_word = bytearray()
 
-        def get_feature_value(self, feature):
-            return self._features[feature]
+        self._feature_values = {feature: Vocabulary() for feature in features}
+        self._feature_columns = {feature: array("i") for feature in features}
+        self._feature_indexes = {}
+        self._feature_bitsets = {}
 
-        def set_feature_value(self, feature, value):
-            self._features[feature] = value
+        self._message_tokens = array("i")
+        self._message_offsets = array("q", [0])
+        self._postings_indptr = np.zeros(1, dtype=OFFSET_DTYPE)
+        self._postings = np.zeros(0, dtype=ID_DTYPE)
+        self._pending_postings = []
+        self._store_messages = store_messages
+        self._document_frequencies = array("q")
+        self._version = 0
 
-        def get_messages(self):
-            return self._messages
+        self._extract_words(messages)
 
-        def add_message(self, message):
-            self._messages.append(message)
+    def __contains__(self, item):
+        word_id = self._vocabulary.lookup(item)
+        return 0 <= word_id < len(self._is_word) and bool(self._is_word[word_id])
 
-    def __init__(self, messages, features):       # Lexicon constructor
-        assert isinstance(messages, list), "Messages must be in a list of lists of str representing tokens"
-        assert isinstance(features, list), "Features must be in a list of str"
+    def get_version(self):
+        """
+        Gets a number which changes whenever words are added or feature values are set
+        :rtype: int
+        """
+        return self._version
 
-        self._all_words = {}
-        self._features = dict.fromkeys(features, {})
+    def _get_word_id(self, original_str):
+        assert original_str in self, "Word '{}' not found in lexicon".format(original_str)
 
-        self._extract_words(messages)
+        return self._vocabulary.get_id(original_str)
 
-    def __contains__(self, item):
-        return item in self._all_words
+    def _mark_words(self, word_ids):
+        """
+        Makes the given tokens words of the lexicon
+        :type word_ids: np.array
+        """
+        self._is_word = _to_bytearray(self._is_word)
+        self._is_word.extend(bytes(len(self._vocabulary) - len(self._is_word)))
+        np.frombuffer(self._is_word, dtype=np.uint8)[word_ids] = 1
+        self._version += 1
 
     def _extract_words(self, messages):
         """
-        Sorts words into a dictionary mapping original string to the corresponding Word object
-        :param messages: list of tokenised messages
-        :type messages: list(list(str))
+        Adds all words of the messages to the lexicon, stores the messages and indexes the messages each word appears in.
+        Messages are consumed in chunks of CHUNK_SIZE, so an iterator over a corpus which does not fit in memory can be
+        processed when messages are not stored.
+        :param messages: tokenised messages
+        :type messages: iterable of list(str) | EncodedMessages
         """
+        if isinstance(messages, EncodedMessages):
+            if messages.vocabulary is self._vocabulary:
+                token_ids = messages.ids
+            else:
+                # Each distinct token is looked up once, then ids are translated into this lexicon's ids as arrays
+                present_ids = np.unique(messages.ids)
+                id_map = np.zeros(len(messages.vocabulary), dtype=ID_DTYPE)
+                id_map[present_ids] = self._vocabulary.encode(messages.vocabulary.decode(present_ids))
+                token_ids = id_map[messages.ids]
+            self._add_token_ids(token_ids, messages.offsets)
+            return
+
+        add_token = self._vocabulary.add
+        token_ids = array("i")
+        offsets = array("q", [0])
         for message in messages:
             assert isinstance(message, list), "Messages must be tokenised as a list of str"
 
             for word in message:
                 assert isinstance(word, str), "Words must be represented as str"
 
-                if word not in self._all_words:
-                    self.add_word(word)
+                token_ids.append(add_token(word))
+            offsets.append(len(token_ids))
+
+            if len(offsets) > self.CHUNK_SIZE:
+                self._add_token_ids(np.frombuffer(token_ids, dtype=ID_DTYPE), np.frombuffer(offsets, dtype=OFFSET_DTYPE))
+                token_ids = array("i")
+                offsets = array("q", [0])
+
+        self._add_token_ids(np.frombuffer(token_ids, dtype=ID_DTYPE), np.frombuffer(offsets, dtype=OFFSET_DTYPE))
+
+    def _add_token_ids(self, token_ids, offsets):
+        """
+        Adds encoded messages to the lexicon
+        :param token_ids: ids in the vocabulary of the tokens of all messages, concatenated
+        :type token_ids: np.array
+        :param offsets: start of each message in token_ids, followed by the total number of token ids
+        :type offsets: np.array
+        """
+        self._mark_words(token_ids)
+
+        message_lengths = np.diff(offsets)
+        if not self._store_messages:
+            # Only the number of distinct messages each token appears in is kept, from the distinct (token, message)
+            # pairs of the chunk, found by sorting them on a combined key
+            n_messages = len(message_lengths)
+            keys = _sorted_unique(token_ids.astype(np.int64) * n_messages +
+                                  np.repeat(np.arange(n_messages), message_lengths))
+            document_frequencies = np.frombuffer(self._get_document_frequency_column(), dtype=np.int64)
+            np.add.at(document_frequencies, keys // max(n_messages, 1), 1)
+            return
+
+        self._message_tokens = _to_array(self._message_tokens, "i")
+        self._message_offsets = _to_array(self._message_offsets, "q")
+        first_message_id = len(self._message_offsets) - 1
+
+        self._message_tokens.frombytes(np.ascontiguousarray(token_ids, dtype=ID_DTYPE).tobytes())
+        self._message_offsets.frombytes((offsets[1:] + self._message_offsets[-1]).astype(OFFSET_DTYPE).tobytes())
+
+        message_ids = np.repeat(np.arange(first_message_id, first_message_id + len(message_lengths), dtype=ID_DTYPE),
+                                message_lengths)
+        self._pending_postings.append((np.array(token_ids, dtype=ID_DTYPE), message_ids))
+
+    def update(self, messages):
+        """
+        Adds more messages to the lexicon, e.g. the next chunk of a corpus which is too large to be processed at once
+        >>> lexicon = Lexicon([], ["pos_tag"], store_messages=False)
+        >>> for chunk in chunks:
+        ...     lexicon.update(tokeniser.transform(chunk))
+
+        :param messages: tokenised messages
+        :type messages: iterable of list(str) | EncodedMessages
+        """
+        assert not isinstance(messages, str), \
+            "Messages must be an iterable of lists of str representing tokens, or EncodedMessages"
+
+        self._extract_words(messages)
+
+    def _add_lexicon(self, other):
+        """
+        Adds the words, feature values and messages of another lexicon to this one. Messages of the other lexicon
+        are numbered after those of this one, and its feature values override those already set.
+        :type other: Lexicon
+        """
+        assert other._store_messages or not self._store_messages, \
+            "A lexicon which does not store messages cannot be added to one which does"
+
+        id_map = self._vocabulary.encode(other._vocabulary.get_tokens())
+        self._mark_words(id_map[other._get_word_ids()])
+
+        for feature, other_values in other._feature_values.items():
+            if feature not in self._feature_values:
+                self._feature_values[feature] = Vocabulary()
+                self._feature_columns[feature] = array("i")
+
+            other_column = _as_numpy(other._feature_columns[feature], ID_DTYPE)
+            token_ids = np.flatnonzero(other_column >= 0)
+            value_map = self._feature_values[feature].encode(other_values.get_tokens())
+            column = np.frombuffer(self._get_feature_column(feature), dtype=ID_DTYPE)
+            column[id_map[token_ids]] = value_map[other_column[token_ids]]
+            self._clear_feature_caches(feature)
+
+        if other._store_messages:
+            indptr, postings = other._get_postings()
+            other_document_frequencies = np.diff(indptr)
+        else:
+            other_document_frequencies = np.zeros(len(other._vocabulary), dtype=np.int64)
+            counted_document_frequencies = _as_numpy(other._document_frequencies, np.int64)
+            other_document_frequencies[:len(counted_document_frequencies)] = counted_document_frequencies
+
+        if not self._store_messages:
+            np.frombuffer(self._get_document_frequency_column(), dtype=np.int64)[id_map] += other_document_frequencies
+            return
+
+        self._message_tokens = _to_array(self._message_tokens, "i")
+        self._message_offsets = _to_array(self._message_offsets, "q")
+        first_message_id = len(self._message_offsets) - 1
+
+        other_offsets = _as_numpy(other._message_offsets, OFFSET_DTYPE)
+        self._message_tokens.frombytes(id_map[_as_numpy(other._message_tokens, ID_DTYPE)].tobytes())
+        self._message_offsets.frombytes((other_offsets[1:] + self._message_offsets[-1]).astype(OFFSET_DTYPE).tobytes())
+
+        self._pending_postings.append((np.repeat(id_map, other_document_frequencies),
+                                       (postings + first_message_id).astype(ID_DTYPE)))
+
+    def _add_message(self, message):
+        """
+        Stores a message without adding its words to the lexicon or indexing it
+        :return: id of the message
+        :rtype: int
+        """
+        self._message_tokens = _to_array(self._message_tokens, "i")
+        self._message_offsets = _to_array(self._message_offsets, "q")
+
+        self._message_tokens.extend(map(self._vocabulary.add, message))
+        self._message_offsets.append(len(self._message_tokens))
+        return len(self._message_offsets) - 2
+
+    def _get_document_frequency_column(self):
+        """
+        :return: the number of messages each token appears in, when messages are not stored, made writable and
+                 extended to cover every token
+        :rtype: array
+        """
+        document_frequencies = _to_array(self._document_frequencies, "q")
+        if len(document_frequencies) < len(self._vocabulary):
+            document_frequencies.extend(array("q", [0]) * (len(self._vocabulary) - len(document_frequencies)))
+        self._document_frequencies = document_frequencies
+        return document_frequencies
+
+    def _get_postings(self):
+        """
+        Merges any pending postings into the inverted index
+        :return: indptr and message ids of the inverted index, covering every token id
+        :rtype: (np.array, np.array)
+        """
+        assert self._store_messages, "Messages are not stored by this lexicon"
+
+        n_tokens = len(self._vocabulary)
+        if not self._pending_postings and len(self._postings_indptr) == n_tokens + 1:
+            return self._postings_indptr, self._postings
+
+        indptr = np.full(n_tokens + 1, self._postings_indptr[-1], dtype=OFFSET_DTYPE)
+        indptr[:len(self._postings_indptr)] = self._postings_indptr
+
+        if self._pending_postings:
+            token_ids = np.concatenate([token_ids for token_ids, _ in self._pending_postings])
+            message_ids = np.concatenate([message_ids for _, message_ids in self._pending_postings])
+
+            # Only pending postings are sorted, on a combined key ordering them by token then message, so that
+            # duplicates end up next to each other
+            n_messages = len(self._message_offsets) - 1
+            keys = _sorted_unique(token_ids.astype(np.int64) * n_messages + message_ids)
+            token_ids = keys // max(n_messages, 1)
+            message_ids = (keys - token_ids * n_messages).astype(ID_DTYPE)
+
+            # Pending postings are of messages added after all indexed ones, so they are inserted at the end of the
+            # postings of their token, keeping them sorted without sorting the whole index again
+            self._postings = np.insert(self._postings, indptr[token_ids + 1], message_ids)
+            indptr[1:] += np.cumsum(np.bincount(token_ids, minlength=n_tokens))
+
+        self._postings_indptr = indptr
+        self._pending_postings = []
 
-                self._all_words[word].add_message(message)
+        return self._postings_indptr, self._postings
 
     def has_feature(self, feature):
-        return feature in self._features
+        return feature in self._feature_values
+
+    def _get_feature_column(self, feature):
+        """
+        :return: the feature's column, made writable and extended to cover every token
+        :rtype: array
+        """
+        column = _to_array(self._feature_columns[feature], "i")
+        if len(column) < len(self._vocabulary):
+            column.extend(array("i", [-1]) * (len(self._vocabulary) - len(column)))
+        self._feature_columns[feature] = column
+        return column
+
+    def _get_feature_index(self, feature):
+        """
+        :return: the tokens with each value of the feature, in CSR form: the ids of the tokens with value i are
+                 token_ids[indptr[i]:indptr[i + 1]], in increasing order
+        :rtype: (np.array, np.array)
+        """
+        if feature not in self._feature_indexes:
+            column = _as_numpy(self._feature_columns[feature], ID_DTYPE)
+            token_ids = np.flatnonzero(column >= 0)
+            value_ids = column[token_ids]
+            token_ids = token_ids[np.argsort(value_ids, kind="stable")]
+
+            n_values = len(self._feature_values[feature])
+            indptr = np.zeros(n_values + 1, dtype=OFFSET_DTYPE)
+            np.cumsum(np.bincount(value_ids, minlength=n_values), out=indptr[1:])
+            self._feature_indexes[feature] = (indptr, token_ids)
+
+        return self._feature_indexes[feature]
+
+    def _clear_feature_caches(self, feature):
+        """
+        Discards everything derived from a feature's column, after it is modified
+        """
+        self._feature_indexes.pop(feature, None)
+        self._feature_bitsets.pop(feature, None)
 
     def set_feature_value(self, original_str, feature, value):
         """
@@ -90,14 +361,54 @@ class Lexicon:
         :param value: value of the feature (e.g. "noun")
         :type value: str
         """
-        assert original_str in self._all_words, "Word '{}' not found in lexicon".format(original_str)
-        assert feature in self._features, "Invalid feature '{}'".format(feature)
+        word_id = self._get_word_id(original_str)
+        assert feature in self._feature_values, "Invalid feature '{}'".format(feature)
+
+        column = self._get_feature_column(feature)
+        column[word_id] = -1 if value is None else self._feature_values[feature].add(value)
+        self._clear_feature_caches(feature)
+        self._version += 1
 
-        self._all_words[original_str].set_feature_value(feature, value)
+    def set_feature_values(self, feature, words, values=None):
+        """
+        Sets the value of a feature for many words at once, e.g. from the output of a part of speech tagger over the
+        whole vocabulary
+        >>> lexicon.set_feature_values("pos_tag", {"apple": "noun", "eat": "verb"})
+        >>> lexicon.set_feature_values("pos_tag", ["apple", "eat"], ["noun", "verb"])
 
-        if value not in self._features[feature]:
-            self._features[feature][value] = []
-        self._features[feature][value].append(original_str)
+        :param feature: one of the features defined during init (e.g. "pos_tag")
+        :type feature: str
+        :param words: word -> value of the feature, or the words if their values are given separately.
+                      If a word is repeated, its last value is kept.
+        :type words: dict(str, str) | list(str) | np.array
+        :param values: value of the feature for each word, None removing the word's value
+        :type values: list(str) | np.array | None
+        """
+        assert feature in self._feature_values, "Invalid feature '{}'".format(feature)
+        if values is None:
+            assert isinstance(words, dict), "Values must be given for each word, or words must map onto values"
+            words, values = list(words.keys()), list(words.values())
+        assert len(words) == len(values), "Got {} words but {} values".format(len(words), len(values))
+
+        word_ids = self._vocabulary.encode(words, add=False)
+        is_word = _as_numpy(self._is_word, np.uint8)
+        found = word_ids < len(is_word)
+        found[found] = is_word[word_ids[found]] == 1
+        found &= word_ids >= 0
+        assert found.all(), "Word '{}' not found in lexicon".format(words[int(np.argmin(found))])
+
+        add_value = self._feature_values[feature].add
+        value_ids = np.fromiter((-1 if value is None else add_value(value) for value in values), dtype=ID_DTYPE,
+                                count=len(values))
+
+        # Only the last occurrence of each word is assigned, so that repeated words get their last value
+        _, last_occurrences = np.unique(word_ids[::-1], return_index=True)
+        last_occurrences = len(word_ids) - 1 - last_occurrences
+
+        column = np.frombuffer(self._get_feature_column(feature), dtype=ID_DTYPE)
+        column[word_ids[last_occurrences]] = value_ids[last_occurrences]
+        self._clear_feature_caches(feature)
+        self._version += 1
 
     def get_words_by_feature_value(self, feature, value):
         """
@@ -111,12 +422,14 @@ class Lexicon:
         :type value: str
         :rtype: str
         """
-        assert feature in self._features, "Invalid feature '{}'".format(feature)
+        assert feature in self._feature_values, "Invalid feature '{}'".format(feature)
 
-        if value not in self._features[feature]:
+        value_id = self._feature_values[feature].lookup(value)
+        if value_id < 0:
             return []
 
-        return self._features[feature][value]
+        indptr, token_ids = self._get_feature_index(feature)
+        return self._vocabulary.decode(token_ids[indptr[value_id]:indptr[value_id + 1]])
 
     def get_feature_value_by_word(self, original_str, feature):
         """
@@ -128,35 +441,489 @@ class Lexicon:
         :return: value of the feature
         :rtype: str
         """
-        assert original_str in self._all_words, "Word '{}' not found in lexicon".format(original_str)
-        assert feature in self._features, "Invalid feature '{}'".format(feature)
+        word_id = self._get_word_id(original_str)
+        assert feature in self._feature_values, "Invalid feature '{}'".format(feature)
+
+        column = self._feature_columns[feature]
+        value_id = column[word_id] if word_id < len(column) else -1
+        if value_id < 0:
+            return None
+        return self._feature_values[feature].get_token(value_id)
+
+    def get_feature_values_by_word(self, feature):
+        """
+        Retrieves the value of a feature for every word which has one
+        :param feature: one of the features defined during init (e.g. "pos_tag")
+        :type feature: str
+        :return: word -> value of the feature
+        :rtype: dict(str, str)
+        """
+        assert feature in self._feature_values, "Invalid feature '{}'".format(feature)
+
+        column = _as_numpy(self._feature_columns[feature], ID_DTYPE)
+        word_ids = np.flatnonzero(column >= 0)
+        return dict(zip(self._vocabulary.decode(word_ids), self._feature_values[feature].decode(column[word_ids])))
+
+    def select_words(self, feature, values):
+        """
+        Selects the words whose feature has one of the provided values, as a WordSet which can be combined with others
+        >>> nouns = lexicon.select_words("pos_tag", "noun")
+        >>> fruit = lexicon.select_words("canonical_form", {"apple", "orange"})
+        >>> (nouns & fruit).get_words()
+        ["apples", "oranges"]
+        >>> len(nouns - fruit)
+        2
+
+        :param feature: one of the features defined during init (e.g. "pos_tag")
+        :type feature: str
+        :param values: value, or values, of the feature (e.g. "noun")
+        :type values: str | iterable of str
+        :rtype: WordSet
+        """
+        assert feature in self._feature_values, "Invalid feature '{}'".format(feature)
+        if isinstance(values, str):
+            values = [values]
+
+        bitsets = self._feature_bitsets.setdefault(feature, {})
+        bits = np.zeros((len(self._vocabulary) + 7) // 8, dtype=np.uint8)
+        for value in values:
+            value_id = self._feature_values[feature].lookup(value)
+            if value_id < 0:
+                continue
 
-        return self._all_words[original_str].get_feature_value(feature)
+            if value_id not in bitsets:
+                indptr, token_ids = self._get_feature_index(feature)
+                token_bits = np.zeros(len(self._vocabulary), dtype=bool)
+                token_bits[token_ids[indptr[value_id]:indptr[value_id + 1]]] = True
+                bitsets[value_id] = np.packbits(token_bits)
+
+            value_bits = bitsets[value_id]
+            bits[:len(value_bits)] |= value_bits
+
+        return WordSet(self, bits)
+
+    def get_word_set(self):
+        """
+        :return: all words of the lexicon, as a WordSet
+        :rtype: WordSet
+        """
+        is_word = _as_numpy(self._is_word, np.uint8).astype(bool)
+        return WordSet(self, np.packbits(np.pad(is_word, (0, len(self._vocabulary) - len(is_word)))))
 
     def get_messages_by_word(self, original_str):
         """
-        Gets a list of all messages in which the provided word appears
+        Gets a list of all messages in which the provided word appears, in the order they were added to the lexicon
+        """
+        return self.get_messages(self.get_message_ids_by_word(original_str))
+
+    def get_message_ids_by_word(self, original_str):
+        """
+        Gets the ids of all messages in which the provided word appears.
+        Messages are numbered in the order they were added to the lexicon.
+        :return: sorted message ids, without duplicates
+        :rtype: np.array
+        """
+        word_id = self._get_word_id(original_str)
+
+        indptr, postings = self._get_postings()
+        return postings[indptr[word_id]:indptr[word_id + 1]]
+
+    def get_message_ids_with_all_words(self, original_strs):
+        """
+        Gets the ids of the messages in which every one of the provided words appears
+        :type original_strs: list(str)
+        :return: sorted message ids
+        :rtype: np.array
+        """
+        postings = sorted((self.get_message_ids_by_word(word) for word in original_strs), key=len)
+        if len(postings) == 0:
+            return np.zeros(0, dtype=ID_DTYPE)
+
+        # Intersecting the shortest lists first keeps the intermediate results small
+        message_ids = postings[0]
+        for word_message_ids in postings[1:]:
+            message_ids = np.intersect1d(message_ids, word_message_ids, assume_unique=True)
+        return message_ids
+
+    def get_message_ids_with_any_words(self, original_strs):
+        """
+        Gets the ids of the messages in which at least one of the provided words appears
+        :type original_strs: list(str)
+        :return: sorted message ids
+        :rtype: np.array
         """
-        assert original_str in self._all_words, "Word '{}' not found in lexicon".format(original_str)
+        postings = [self.get_message_ids_by_word(word) for word in original_strs]
+        if len(postings) == 0:
+            return np.zeros(0, dtype=ID_DTYPE)
+
+        return np.unique(np.concatenate(postings))
+
+    def get_messages(self, message_ids):
+        """
+        Gets messages by id
+        :type message_ids: iterable of int
+        :rtype: list(list(str))
+        """
+        assert self._store_messages, "Messages are not stored by this lexicon"
+
+        offsets = self._message_offsets
+        return [self._vocabulary.decode(self._message_tokens[offsets[i]:offsets[i + 1]])
+                for i in np.asarray(message_ids, dtype=np.int64).tolist()]
 
-        return self._all_words[original_str].get_messages()
+    def get_document_frequency(self, original_str):
+        """
+        Gets the number of messages in which the provided word appears
+        :rtype: int
+        """
+        return int(self.get_document_frequencies([original_str])[0])
+
+    def get_document_frequencies(self, original_strs=None):
+        """
+        Gets the number of messages in which each of the provided words appears
+        :param original_strs: words to count. All words in the lexicon, in the order of get_words(), if None.
+        :type original_strs: list(str) | None
+        :rtype: np.array
+        """
+        if original_strs is None:
+            original_strs = self.get_words()
+        word_ids = np.fromiter(map(self._get_word_id, original_strs), dtype=np.int64, count=len(original_strs))
+
+        if not self._store_messages:
+            return np.frombuffer(self._get_document_frequency_column(), dtype=np.int64)[word_ids]
+
+        indptr, _ = self._get_postings()
+        return indptr[word_ids + 1] - indptr[word_ids]
+
+    def get_incidence_matrix(self):
+        """
+        Gets which messages each word appears in, as a sparse matrix
+        :return: matrix of shape (number of words, number of messages) with a 1 where a word appears in a message.
+                 Rows are in the order of get_words(), columns in the order messages were added.
+        :rtype: scipy.sparse.csr_matrix
+        """
+        indptr, postings = self._get_postings()
+        n_messages = len(self._message_offsets) - 1
+        incidence = sp.csr_matrix((np.ones(len(postings), dtype=np.int64), postings, indptr),
+                                  shape=(len(self._vocabulary), n_messages))
+        return incidence[self._get_word_ids()]
+
+    def get_cooccurrence_matrix(self, window=None):
+        """
+        Counts how often each pair of words occurs together
+        :param window: if None, counts the messages in which both words appear. Otherwise, counts the occurrences of
+                       the words at most window tokens apart in the same message. Each pair of occurrences is
+                       counted once, so that the diagonal counts repetitions of a word within the window.
+        :type window: int | None
+        :return: symmetric matrix of shape (number of words, number of words), rows and columns in the order of
+                 get_words()
+        :rtype: scipy.sparse.csr_matrix
+        """
+        if window is None:
+            incidence = self.get_incidence_matrix()
+            return (incidence @ incidence.T).tocsr()
+
+        assert window >= 1, "Invalid window {}".format(window)
+        assert self._store_messages, "Messages are not stored by this lexicon"
+
+        word_ids = self._get_word_ids()
+        word_rows = np.full(len(self._vocabulary), -1, dtype=np.int64)
+        word_rows[word_ids] = np.arange(len(word_ids))
+
+        offsets = _as_numpy(self._message_offsets, OFFSET_DTYPE)
+        token_rows = word_rows[_as_numpy(self._message_tokens, ID_DTYPE)]
+        token_messages = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+        # Pairs of tokens d apart are found by comparing the flat token array with itself shifted by d
+        rows, columns = [], []
+        for distance in range(1, window + 1):
+            left, right = token_rows[:-distance], token_rows[distance:]
+            pairs = (token_messages[:-distance] == token_messages[distance:]) & (left >= 0) & (right >= 0)
+            rows.append(left[pairs])
+            columns.append(right[pairs])
+        rows, columns = np.concatenate(rows), np.concatenate(columns)
+        counts = sp.csr_matrix((np.ones(len(rows), dtype=np.int64), (rows, columns)),
+                               shape=(len(word_ids), len(word_ids)))
+
+        return (counts + counts.T - sp.diags(counts.diagonal(), dtype=np.int64)).tocsr()
 
     def add_message_to_word(self, original_str, message):
         assert original_str in message, "Word '{}' not found in message '{}'".format(original_str, message)
-        assert original_str in self._all_words, "Word '{}' not found in lexicon".format(original_str)
+        word_id = self._get_word_id(original_str)
 
-        self._all_words[original_str].add_message(message)
+        if not self._store_messages:
+            self._get_document_frequency_column()[word_id] += 1
+            return
+
+        message_id = self._add_message(message)
+        self._pending_postings.append((np.array([word_id], dtype=ID_DTYPE), np.array([message_id], dtype=ID_DTYPE)))
 
     def add_word(self, original_str):
         """
         Adds a word not in the list of messages provided at init.
         """
-        assert original_str not in self._all_words, "Word '{}' already exists in lexicon".format(original_str)
+        assert original_str not in self, "Word '{}' already exists in lexicon".format(original_str)
 
-        self._all_words[original_str] = self._Word(original_str, self._features)
+        self._mark_words([self._vocabulary.add(original_str)])
 
     def get_features(self):
-        return self._features.keys()
+        return self._feature_values.keys()
+
+    def _get_word_ids(self):
+        """
+        :return: token ids of all words, in increasing order
+        :rtype: np.array
+        """
+        return np.flatnonzero(_as_numpy(self._is_word, np.uint8))
 
     def get_words(self):
-        return self._all_words.keys()
+        return self._vocabulary.decode(self._get_word_ids())
+
+    def save(self, path):
+        """
+        Saves the lexicon to a directory of flat binary arrays, which load can memory-map.
+        The directory is created if it does not exist. It must not be one a lexicon is memory-mapped from.
+        :type path: str
+        """
+        arrays = {
+            "is_word": np.frombuffer(bytes(self._is_word).ljust(len(self._vocabulary), b"\0"), dtype=np.uint8)
+        }
+        if self._store_messages:
+            arrays["message_tokens"] = _as_numpy(self._message_tokens, ID_DTYPE)
+            arrays["message_offsets"] = _as_numpy(self._message_offsets, OFFSET_DTYPE)
+            arrays["postings_indptr"], arrays["postings"] = self._get_postings()
+        else:
+            arrays["document_frequencies"] = _as_numpy(self._get_document_frequency_column(), np.int64)
+        arrays["tokens"], arrays["token_offsets"] = self._vocabulary.to_arrays()
+
+        features = list(self._feature_values)
+        for i, feature in enumerate(features):
+            arrays["feature_{}_values".format(i)], arrays["feature_{}_value_offsets".format(i)] = \
+                self._feature_values[feature].to_arrays()
+            arrays["feature_{}_column".format(i)] = _as_numpy(self._get_feature_column(feature), ID_DTYPE)
+
+        os.makedirs(path, exist_ok=True)
+        for name, values in arrays.items():
+            np.save(os.path.join(path, name + ".npy"), values)
+        with open(os.path.join(path, "lexicon.json"), "w") as f:
+            json.dump({"format_version": self.FORMAT_VERSION, "features": features,
+                       "store_messages": self._store_messages}, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Loads a lexicon saved with save
+        :param mmap: whether to memory-map the arrays rather than read them into memory. Memory-mapped arrays are
+                     shared through the page cache by every process which loads the same lexicon, and are only copied
+                     into a process which modifies its lexicon.
+        :type mmap: bool
+        :rtype: Lexicon
+        """
+        with open(os.path.join(path, "lexicon.json")) as f:
+            header = json.load(f)
+        assert header["format_version"] == cls.FORMAT_VERSION, \
+            "Unsupported lexicon format version {}".format(header["format_version"])
+
+        def load_array(name):
+            return np.load(os.path.join(path, name + ".npy"), mmap_mode="r" if mmap else None)
+
+        lexicon = cls.__new__(cls)
+        lexicon._vocabulary = Vocabulary.from_arrays(load_array("tokens"), load_array("token_offsets"))
+        lexicon._is_word = load_array("is_word")
+
+        lexicon._feature_values = {}
+        lexicon._feature_columns = {}
+        lexicon._feature_indexes = {}
+        lexicon._feature_bitsets = {}
+        for i, feature in enumerate(header["features"]):
+            lexicon._feature_values[feature] = Vocabulary.from_arrays(
+                load_array("feature_{}_values".format(i)), load_array("feature_{}_value_offsets".format(i)))
+            lexicon._feature_columns[feature] = load_array("feature_{}_column".format(i))
+
+        lexicon._store_messages = header.get("store_messages", True)
+        if lexicon._store_messages:
+            lexicon._message_tokens = load_array("message_tokens")
+            lexicon._message_offsets = load_array("message_offsets")
+            lexicon._postings_indptr = load_array("postings_indptr")
+            lexicon._postings = load_array("postings")
+            lexicon._document_frequencies = array("q")
+        else:
+            lexicon._message_tokens = array("i")
+            lexicon._message_offsets = array("q", [0])
+            lexicon._postings_indptr = np.zeros(1, dtype=OFFSET_DTYPE)
+            lexicon._postings = np.zeros(0, dtype=ID_DTYPE)
+            lexicon._document_frequencies = load_array("document_frequencies")
+        lexicon._pending_postings = []
+        lexicon._version = 0
+
+        return lexicon
+
+    @classmethod
+    def merge(cls, lexicons):
+        """
+        Merges lexicons, e.g. built on disjoint shards of a corpus, into a new lexicon.
+        The result is the same as building one lexicon from the messages of each lexicon in turn: tokens are numbered in
+        order of first appearance across lexicons, message ids of each lexicon are offset by the number of messages
+        in the lexicons before it, and where lexicons set different values of a feature for a word, the last one wins.
+        :type lexicons: list(Lexicon)
+        :rtype: Lexicon
+        """
+        features = []
+        for lexicon in lexicons:
+            features.extend(feature for feature in lexicon.get_features() if feature not in features)
+
+        merged = cls([], features, store_messages=all(lexicon._store_messages for lexicon in lexicons))
+        for lexicon in lexicons:
+            merged._add_lexicon(lexicon)
+        return merged
+
+    @classmethod
+    def build(cls, messages, features, n_jobs=None, shard_size=100000, store_messages=True):
+        """
+        Builds a lexicon in worker processes, each of which builds a partial lexicon on a shard of consecutive
+        messages. Shards are merged in order as they are completed, so the result is identical to
+        Lexicon(messages, features, store_messages).
+        :param messages: tokenised messages
+        :type messages: iterable of list(str) | EncodedMessages
+        :param features: names of the linguistic features words can have (e.g. "pos_tag")
+        :type features: list(str)
+        :param n_jobs: number of worker processes. None or 1 builds the lexicon in the current process,
+                       -1 uses one process per CPU.
+        :type n_jobs: int | None
+        :param shard_size: number of messages sent to a worker process at a time
+        :type shard_size: int
+        :type store_messages: bool
+        :rtype: Lexicon
+        """
+        n_workers = get_n_workers(n_jobs)
+        if n_workers == 1 or isinstance(messages, EncodedMessages):
+            # Encoded messages are already processed with array operations
+            return cls(messages, features, store_messages)
+
+        lexicon = cls([], features, store_messages)
+        for shard_lexicon in map_chunks_in_processes(_build_shard, iter_chunks(messages, shard_size), n_workers,
+                                                     features, store_messages):
+            lexicon._add_lexicon(shard_lexicon)
+
+        return lexicon
+
+class WordSet:
+    """
+    Set of words of a lexicon, stored as a bitset over token ids so that sets can be combined with bitwise operations:
+    & (and), | (or), - (difference) and ~ (complement within the words of the lexicon).
+    Iterating over it yields its words in the order of Lexicon.get_words.
+    :ivar lexicon: lexicon the words belong to
+    :type lexicon: Lexicon
+    :ivar bits: whether each token is in the set, packed with np.packbits. Tokens past its end are not.
+    :type bits: np.array
+    """
+    def __init__(self, lexicon, bits):
+        self.lexicon = lexicon
+        self.bits = bits
+
+    def _align(self, other):
+        """
+        :return: the bits of both sets, padded to the same length
+        :rtype: (np.array, np.array)
+        """
+        assert isinstance(other, WordSet) and other.lexicon is self.lexicon, \
+            "Only sets of words of the same lexicon can be combined"
+
+        n_bytes = max(len(self.bits), len(other.bits))
+        return (np.pad(self.bits, (0, n_bytes - len(self.bits))),
+                np.pad(other.bits, (0, n_bytes - len(other.bits))))
+
+    def __and__(self, other):
+        bits, other_bits = self._align(other)
+        return WordSet(self.lexicon, bits & other_bits)
+
+    def __or__(self, other):
+        bits, other_bits = self._align(other)
+        return WordSet(self.lexicon, bits | other_bits)
+
+    def __sub__(self, other):
+        bits, other_bits = self._align(other)
+        return WordSet(self.lexicon, bits & ~other_bits)
+
+    def __invert__(self):
+        return self.lexicon.get_word_set() - self
+
+    def __len__(self):
+        return int(_BIT_COUNTS[self.bits].sum(dtype=np.int64))
+
+    def __contains__(self, item):
+        token_id = self.lexicon._vocabulary.lookup(item)
+        return 0 <= token_id < len(self.bits) * 8 and bool(self.bits[token_id // 8] & (0x80 >> (token_id % 8)))
+
+    def __iter__(self):
+        return iter(self.get_words())
+
+    def get_word_ids(self):
+        """
+        :return: token ids of the words in the set, in increasing order
+        :rtype: np.array
+        """
+        return np.flatnonzero(np.unpackbits(self.bits))
+
+    def get_words(self):
+        """
+        :rtype: list(str)
+        """
+        return self.lexicon._vocabulary.decode(self.get_word_ids())
+
+_BIT_COUNTS = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def _build_shard(messages, features, store_messages):
+    """
+    Builds the partial lexicon of a shard of messages in a worker process
+    :rtype: Lexicon
+    """
+    lexicon = Lexicon(messages, features, store_messages)
+    if store_messages:
+        # Indexing the messages here rather than after merging spreads the work across processes
+        lexicon._get_postings()
+    return lexicon
+
+def _sorted_unique(values):
+    """
+    Sorts values in place and removes duplicates. Faster than np.unique on large arrays of integers.
+    :type values: np.array
+    :rtype: np.array
+    """
+    if len(values) == 0:
+        return values
+
+    values.sort()
+    return values[np.concatenate(([True], values[1:] != values[:-1]))]
+
+def _to_array(values, typecode):
+    """
+    Returns values as a growable, writable array, copying them if they are not one already (e.g. after load)
+    :type values: array | np.array
+    :rtype: array
+    """
+    if isinstance(values, array):
+        return values
+
+    result = array(typecode)
+    result.frombytes(np.ascontiguousarray(values).tobytes())
+    return result
+
+def _to_bytearray(values):
+    """
+    Returns values as a growable, writable bytearray, copying them if they are not one already (e.g. after load)
+    :type values: bytearray | np.array
+    :rtype: bytearray
+    """
+    if isinstance(values, bytearray):
+        return values
+    return bytearray(np.ascontiguousarray(values).tobytes())
+
+def _as_numpy(values, dtype):
+    """
+    Views values as an np.array without copying them
+    :type values: array | bytearray | np.array
+    :rtype: np.array
+    """
+    if isinstance(values, (array, bytearray)):
+        return np.frombuffer(values, dtype=dtype)
+    return values
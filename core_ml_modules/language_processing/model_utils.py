@@ -27,13 +27,76 @@ def select_predicted_scores(scores, predicted_labels, classes):
     if len(scores.shape) == 1:
         return scores
 
-    predicted_scores = []
-    for score_set, label in zip(scores, predicted_labels):
-        score_index = list(classes).index(label)
-        score = list(score_set)[score_index]
-        predicted_scores.append(score)
+    label_indices = _find_class_indices(predicted_labels, classes)
+    return scores[np.arange(len(scores)), label_indices]
 
-    return np.array(predicted_scores)
+def rank_predicted_scores(scores, classes, k=1):
+    """
+    Ranks the classes of each sample by score, returning the k best labels and their scores along with the margin
+    between the best and second best score (e.g. for uncertainty sampling in active learning).
+    Binary scores of shape (n_samples,) from decision_function() are scores for classes[1], so they are ranked
+    against their negation for classes[0].
+    :param scores: Scores from predict_proba(), predict_log_proba(), or decision_function()
+                   shape (n_samples,) if n_classes == 2 else (n_samples, n_classes)
+    :type scores: np.array
+    :param classes: Class labels known to the classifier, from classes_
+    :type classes: np.array
+    :param k: number of labels to return per sample
+    :type k: int
+    :return: top labels, shape (n_samples, k), and their scores, shape (n_samples, k), both from best to worst,
+             and margins between the best and second best score, shape (n_samples,)
+    :rtype: (np.array, np.array, np.array)
+    """
+    classes = np.asarray(classes)
+    if len(scores.shape) == 1:
+        scores = np.column_stack((-scores, scores))
+    assert scores.shape[1] == len(classes), "Scores must have one column per class"
+    assert 1 <= k <= len(classes), "k must be between 1 and the number of classes"
+
+    # Only the best max(k, 2) scores of each sample need sorting, so partition them out first
+    n_best = min(max(k, 2), len(classes))
+    if n_best < len(classes):
+        best_indices = np.argpartition(-scores, n_best - 1, axis=1)[:, :n_best]
+    else:
+        best_indices = np.tile(np.arange(len(classes)), (len(scores), 1))
+    best_scores = np.take_along_axis(scores, best_indices, axis=1)
+
+    order = np.argsort(-best_scores, axis=1, kind="stable")
+    best_indices = np.take_along_axis(best_indices, order, axis=1)
+    best_scores = np.take_along_axis(best_scores, order, axis=1)
+
+    if n_best > 1:
+        margins = best_scores[:, 0] - best_scores[:, 1]
+    else:
+        margins = np.full(len(scores), np.inf)
+
+    return classes[best_indices[:, :k]], best_scores[:, :k], margins
+
+def _find_class_indices(labels, classes):
+    """
+    Finds the index of each label in classes
+    :rtype: np.array
+    """
+    classes = np.asarray(classes)
+    labels = np.asarray(labels)
+
+    sorter = np.argsort(classes, kind="stable")
+    positions = np.searchsorted(classes, labels, sorter=sorter)
+    indices = sorter[np.minimum(positions, len(classes) - 1)]
+
+    not_found = classes[indices] != labels
+    if np.any(not_found):
+        raise ValueError("Labels not in classes: {}".format(labels[not_found][:10].tolist()))
+
+    return indices
+
+def default_form_word(word, lexicon):
+    """
+    Uses the word itself as its form, by default, if there is no information on its form in lexicon
+    :type word: str
+    :rtype: str
+    """
+    return word
 
 def default_form_pos(word, lexicon):
     """
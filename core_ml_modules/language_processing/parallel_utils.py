@@ -0,0 +1,45 @@
+import itertools
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+def get_n_workers(n_jobs):
+    """
+    :param n_jobs: number of worker processes requested. None means 1, -1 means one per CPU.
+    :type n_jobs: int | None
+    :rtype: int
+    """
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return os.cpu_count() or 1
+    return n_jobs
+
+def iter_chunks(items, chunk_size):
+    """
+    Reads an iterable in consecutive chunks, without reading more than one chunk ahead
+    :type items: iterable
+    :type chunk_size: int
+    :rtype: generator of list
+    """
+    items = iter(items)
+    return iter(lambda: list(itertools.islice(items, chunk_size)), [])
+
+def map_chunks_in_processes(function, chunks, n_workers, *args):
+    """
+    Applies function(chunk, *args) to each chunk in worker processes, yielding the results in the order of the chunks.
+    Only a bounded number of chunks are in flight at once so that the input is not read in full.
+    :param function: module-level function, so that it can be sent to worker processes
+    :type function: function
+    :type chunks: iterable of list
+    :type n_workers: int
+    :rtype: generator
+    """
+    with ProcessPoolExecutor(n_workers) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(function, chunk, *args))
+            if len(pending) >= 2 * n_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
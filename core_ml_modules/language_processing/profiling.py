@@ -0,0 +1,208 @@
+import json
+import logging
+import time
+import tracemalloc
+
+import numpy as np
+import scipy.sparse as sp
+
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.pipeline import Pipeline
+from sklearn.utils.metaestimators import available_if
+
+class InMemoryCollector:
+    """
+    Collects profiling records in a list
+    :ivar records: records collected so far
+    :type records: list(dict)
+    """
+    def __init__(self):
+        self.records = []
+
+    def collect(self, record):
+        self.records.append(record)
+
+class JSONLinesCollector:
+    """
+    Appends profiling records to a file, one JSON object per line
+    """
+    def __init__(self, path):
+        """
+        :param path: file to append records to
+        :type path: str
+        """
+        self.path = path
+
+    def collect(self, record):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+class LoggingCollector:
+    """
+    Logs profiling records as JSON
+    """
+    def __init__(self, logger=None, level=logging.INFO):
+        """
+        :param logger: logger to log with. Defaults to this module's logger.
+        :type logger: logging.Logger | None
+        :param level: level to log records at
+        :type level: int
+        """
+        self.logger = logging.getLogger(__name__) if logger is None else logger
+        self.level = level
+
+    def collect(self, record):
+        self.logger.log(self.level, "%s", json.dumps(record))
+
+def _has_method(method):
+    return lambda self: hasattr(self.estimator, method)
+
+class StageProfiler(BaseEstimator, TransformerMixin):
+    """
+    Wraps an estimator to profile it as a stage of a scikit-learn Pipeline.
+    Every call to fit, transform, fit_transform and, if the estimator has them, predict, predict_proba,
+    predict_log_proba and decision_function produces a record of its wall time, CPU time, rows per second, output
+    shape, number of non-zero values and density, and optionally peak memory, which is sent to the collector.
+    Sci-kit learn documentation on creating estimators: http://scikit-learn.org/dev/developers/contributing.html#rolling-your-own-estimator
+    """
+    def __init__(self, estimator, name=None, collector=None, trace_memory=False):
+        """
+        :param estimator: estimator to profile
+        :param name: name of the stage in records. Defaults to the estimator's class name.
+        :type name: str | None
+        :param collector: object whose collect(record) method receives each record. Defaults to an
+                          InMemoryCollector, available as collector_ after the first call.
+        :param trace_memory: whether to measure peak memory with tracemalloc, which slows execution down
+        :type trace_memory: bool
+        """
+        self.estimator = estimator
+        self.name = name
+        self.collector = collector
+        self.trace_memory = trace_memory
+
+    def fit(self, X, y=None, **fit_params):
+        self._profile("fit", X, lambda: self.estimator.fit(X, y, **fit_params))
+        return self
+
+    def transform(self, X):
+        return self._profile("transform", X, lambda: self.estimator.transform(X))
+
+    def fit_transform(self, X, y=None, **fit_params):
+        if hasattr(self.estimator, "fit_transform"):
+            return self._profile("fit_transform", X, lambda: self.estimator.fit_transform(X, y, **fit_params))
+        return self._profile("fit_transform", X, lambda: self.estimator.fit(X, y, **fit_params).transform(X))
+
+    @available_if(_has_method("predict"))
+    def predict(self, X):
+        return self._profile("predict", X, lambda: self.estimator.predict(X))
+
+    @available_if(_has_method("predict_proba"))
+    def predict_proba(self, X):
+        return self._profile("predict_proba", X, lambda: self.estimator.predict_proba(X))
+
+    @available_if(_has_method("predict_log_proba"))
+    def predict_log_proba(self, X):
+        return self._profile("predict_log_proba", X, lambda: self.estimator.predict_log_proba(X))
+
+    @available_if(_has_method("decision_function"))
+    def decision_function(self, X):
+        return self._profile("decision_function", X, lambda: self.estimator.decision_function(X))
+
+    @property
+    def classes_(self):
+        return self.estimator.classes_
+
+    def _profile(self, method, X, call):
+        """
+        Runs call, sending a record of its execution to the collector
+        :param method: name of the method being called
+        :type method: str
+        :param X: input of the call
+        :param call: function making the call
+        :type call: function
+        :return: output of the call
+        """
+        if not hasattr(self, "collector_"):
+            self.collector_ = InMemoryCollector() if self.collector is None else self.collector
+
+        started_tracing = False
+        if self.trace_memory:
+            if tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.start()
+                started_tracing = True
+            initial_memory = tracemalloc.get_traced_memory()[0]
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            output = call()
+        finally:
+            wall_seconds = time.perf_counter() - wall_start
+            cpu_seconds = time.process_time() - cpu_start
+            peak_memory = None
+            if self.trace_memory:
+                peak_memory = tracemalloc.get_traced_memory()[1] - initial_memory
+                if started_tracing:
+                    tracemalloc.stop()
+
+        n_rows = _count_rows(X)
+        record = {
+            "stage": self.name if self.name is not None else type(self.estimator).__name__,
+            "method": method,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "wall_seconds": wall_seconds,
+            "cpu_seconds": cpu_seconds,
+            "n_rows": n_rows,
+            "rows_per_second": n_rows / wall_seconds if n_rows is not None and wall_seconds > 0 else None,
+            "peak_memory_bytes": peak_memory
+        }
+        # fit returns the estimator rather than an output to describe
+        if method != "fit" and output is not self.estimator:
+            record.update(_describe_output(output))
+        self.collector_.collect(record)
+
+        return output
+
+def _count_rows(X):
+    if hasattr(X, "shape"):
+        return int(X.shape[0])
+    if hasattr(X, "__len__"):
+        return len(X)
+    return None
+
+def _describe_output(output):
+    """
+    :return: shape, number of non-zero values and density of a matrix, or the number of rows of other outputs
+    :rtype: dict
+    """
+    if sp.issparse(output) or isinstance(output, np.ndarray):
+        n_values = int(np.prod(output.shape))
+        nnz = int(output.nnz) if sp.issparse(output) else int(np.count_nonzero(output))
+        return {
+            "output_shape": list(output.shape),
+            "output_nnz": nnz,
+            "output_density": nnz / n_values if n_values > 0 else None
+        }
+
+    return {"output_shape": [_count_rows(output)]}
+
+def profile_pipeline(pipeline, collector, trace_memory=False):
+    """
+    Wraps every step of a pipeline in a StageProfiler named after the step
+    :type pipeline: sklearn.pipeline.Pipeline
+    :param collector: object whose collect(record) method receives the records of every step
+    :param trace_memory: whether to measure peak memory with tracemalloc, which slows execution down
+    :type trace_memory: bool
+    :return: a new pipeline with the same steps, wrapped
+    :rtype: sklearn.pipeline.Pipeline
+    """
+    steps = []
+    for name, estimator in pipeline.steps:
+        if estimator is None or estimator == "passthrough":
+            steps.append((name, estimator))
+        else:
+            steps.append((name, StageProfiler(estimator, name=name, collector=collector, trace_memory=trace_memory)))
+
+    return Pipeline(steps)
@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+import numpy as np
+from sklearn.pipeline import Pipeline
+
+from . import model_utils
+
+class MicroBatcher:
+    """
+    Serves predictions for single messages from a fitted pipeline (e.g. Tokeniser, NGramFrequencyExtractor and a
+    classifier), collecting concurrent requests into batches so that the pipeline runs once per batch rather than once
+    per message.
+    A batch is run as soon as it has max_batch_size messages, or max_delay seconds after its first message arrived.
+    Usage, from within a running event loop:
+        async with MicroBatcher(pipeline) as batcher:
+            label, score = await batcher.predict("I eat apples")
+    The score of a label is from predict_proba if the classifier has it, or from decision_function otherwise.
+    """
+    def __init__(self, pipeline, max_batch_size=64, max_delay=0.005, executor=None, collector=None,
+                 latency_window=10000):
+        """
+        :param pipeline: fitted classifier, or Pipeline ending with one, with predict, classes_ and either
+                         predict_proba or decision_function
+        :param max_batch_size: largest number of messages run in one batch
+        :type max_batch_size: int
+        :param max_delay: longest time in seconds a message waits for other messages to batch with
+        :type max_delay: float
+        :param executor: executor batches are run in, so the event loop keeps accepting requests meanwhile. Defaults to
+                         the event loop's default executor.
+        :type executor: concurrent.futures.Executor | None
+        :param collector: object whose collect(record) method receives a record of each batch, as in profiling
+        :param latency_window: number of most recent request latencies kept for percentiles
+        :type latency_window: int
+        """
+        assert max_batch_size >= 1, "max_batch_size must be at least 1"
+        assert max_delay >= 0, "max_delay cannot be negative"
+
+        self.pipeline = pipeline
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.executor = executor
+        self.collector = collector
+
+        self._queue = None
+        self._task = None
+        self._latencies = deque(maxlen=latency_window)
+        self._n_requests = 0
+        self._n_batches = 0
+        self._max_queue_depth = 0
+
+    async def start(self):
+        """
+        Starts batching requests in the running event loop
+        """
+        assert self._task is None, "MicroBatcher already started"
+        self._queue = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """
+        Stops batching requests, once those already received have been served
+        """
+        assert self._task is not None, "MicroBatcher not started"
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.stop()
+
+    async def predict(self, message):
+        """
+        Predicts the label of a message, in a batch with other concurrent requests
+        :param message: raw message, as passed to the pipeline
+        :type message: str
+        :return: predicted label and its score
+        :rtype: (str, float)
+        """
+        assert self._task is not None, "MicroBatcher not started"
+        if self._task.done():
+            raise RuntimeError("MicroBatcher stopped serving requests after an unexpected error")
+
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((message, future, time.perf_counter()))
+        self._max_queue_depth = max(self._max_queue_depth, self._queue.qsize())
+        return await future
+
+    def get_stats(self):
+        """
+        :return: number of requests and batches served so far, mean batch size, current and largest number of queued
+                 requests, and the 50th, 90th and 99th percentiles of the latencies of recent requests, in seconds
+        :rtype: dict
+        """
+        latencies = np.array(self._latencies)
+        percentiles = np.percentile(latencies, [50, 90, 99]) if len(latencies) > 0 else [None] * 3
+        return {
+            "n_requests": self._n_requests,
+            "n_batches": self._n_batches,
+            "mean_batch_size": self._n_requests / self._n_batches if self._n_batches > 0 else None,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "max_queue_depth": self._max_queue_depth,
+            "latency_p50_seconds": percentiles[0],
+            "latency_p90_seconds": percentiles[1],
+            "latency_p99_seconds": percentiles[2]
+        }
+
+    async def _run(self):
+        """
+        Collects requests into batches and serves them until stopped
+        """
+        loop = asyncio.get_running_loop()
+        batch = []
+        error = RuntimeError("MicroBatcher stopped")
+        try:
+            stopping = False
+            while not stopping:
+                request = await self._queue.get()
+                if request is None:
+                    break
+
+                batch = [request]
+                deadline = loop.time() + self.max_delay
+                while len(batch) < self.max_batch_size:
+                    if self._queue.empty():
+                        timeout = deadline - loop.time()
+                        if timeout <= 0:
+                            break
+                        try:
+                            request = await asyncio.wait_for(self._queue.get(), timeout)
+                        except asyncio.TimeoutError:
+                            break
+                    else:
+                        request = self._queue.get_nowait()
+
+                    if request is None:
+                        stopping = True
+                        break
+                    batch.append(request)
+
+                await self._serve(loop, batch)
+        except Exception as e:
+            logging.getLogger(__name__).exception("MicroBatcher stopped serving requests after an unexpected error")
+            error = RuntimeError("MicroBatcher stopped serving requests after an unexpected error: {!r}".format(e))
+        finally:
+            # Requests which will not be served are failed rather than left waiting forever
+            while not self._queue.empty():
+                request = self._queue.get_nowait()
+                if request is not None:
+                    batch.append(request)
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(error)
+
+    async def _serve(self, loop, batch):
+        """
+        Runs the pipeline on a batch of requests and resolves their futures
+        :param batch: message, future and enqueue time of each request
+        :type batch: list((str, asyncio.Future, float))
+        """
+        queue_depth = self._queue.qsize()
+        messages = [message for message, _, _ in batch]
+
+        start = time.perf_counter()
+        try:
+            labels, scores = await loop.run_in_executor(self.executor, self._predict_batch, messages)
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        end = time.perf_counter()
+
+        for (_, future, enqueue_time), label, score in zip(batch, labels, scores):
+            if not future.done():
+                future.set_result((label, score))
+            self._latencies.append(end - enqueue_time)
+        self._n_requests += len(batch)
+        self._n_batches += 1
+
+        if self.collector is not None:
+            # A failing collector must not stop requests from being served
+            try:
+                self.collector.collect({
+                    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                    "batch_size": len(batch),
+                    "queue_depth": queue_depth,
+                    "wall_seconds": end - start
+                })
+            except Exception:
+                logging.getLogger(__name__).exception("Failed to collect the record of a batch")
+
+    def _predict_batch(self, messages):
+        """
+        :return: predicted label and its score for each message
+        :rtype: (list, list(float))
+        """
+        # Messages are transformed once, then both predictions and scores are computed from the same features
+        classifier = self.pipeline
+        features = messages
+        if isinstance(self.pipeline, Pipeline):
+            classifier = self.pipeline[-1]
+            features = self.pipeline[:-1].transform(messages)
+
+        predicted_labels = classifier.predict(features)
+        if hasattr(classifier, "predict_proba"):
+            scores = classifier.predict_proba(features)
+        else:
+            scores = classifier.decision_function(features)
+        predicted_scores = model_utils.select_predicted_scores(scores, predicted_labels, classifier.classes_)
+        return np.asarray(predicted_labels).tolist(), np.asarray(predicted_scores).tolist()
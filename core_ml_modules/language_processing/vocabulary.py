@@ -0,0 +1,184 @@
+from array import array
+
+import numpy as np
+
+ID_DTYPE = np.int32
+OFFSET_DTYPE = np.int64
+
+class Vocabulary:
+    """
+    Interned vocabulary mapping each distinct token onto a dense integer id, in order of first appearance
+    :ivar _ids: token -> id
+    :type _ids: dict(str, int)
+    :ivar _tokens: id -> token
+    :type _tokens: list(str)
+    """
+    def __init__(self, tokens=None):
+        self._ids = {}
+        self._tokens = []
+
+        if tokens is not None:
+            for token in tokens:
+                self.add(token)
+
+    def __contains__(self, token):
+        return token in self._ids
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def __iter__(self):
+        return iter(self._tokens)
+
+    def add(self, token):
+        """
+        Adds a token to the vocabulary if it is not already in it
+        :return: id of the token
+        :rtype: int
+        """
+        token_id = self._ids.get(token)
+        if token_id is None:
+            token_id = self._ids[token] = len(self._tokens)
+            self._tokens.append(token)
+        return token_id
+
+    def get_id(self, token):
+        assert token in self._ids, "Token '{}' not found in vocabulary".format(token)
+
+        return self._ids[token]
+
+    def lookup(self, token):
+        """
+        :return: id of the token, or -1 if it is not in the vocabulary
+        :rtype: int
+        """
+        return self._ids.get(token, -1)
+
+    def get_token(self, token_id):
+        return self._tokens[token_id]
+
+    def get_tokens(self):
+        """
+        :return: all tokens, indexed by id
+        :rtype: list(str)
+        """
+        return self._tokens
+
+    def encode(self, tokens, add=True):
+        """
+        Converts tokens to ids
+        :param add: whether tokens not in the vocabulary are added to it. If not, they are encoded as -1.
+        :type add: bool
+        :rtype: np.array
+        """
+        if add:
+            return np.fromiter((self.add(token) for token in tokens), dtype=ID_DTYPE)
+
+        get_id = self._ids.get
+        return np.fromiter((get_id(token, -1) for token in tokens), dtype=ID_DTYPE)
+
+    def decode(self, token_ids):
+        """
+        Converts ids back to tokens
+        :rtype: list(str)
+        """
+        tokens = self._tokens
+        return [tokens[token_id] for token_id in np.asarray(token_ids).tolist()]
+
+    def to_arrays(self):
+        """
+        Converts the vocabulary to flat arrays, e.g. to save it with np.save
+        :return: all tokens concatenated and encoded as UTF-8, keeping lone surrogates, and the character offsets of
+                 each token in them followed by the total number of characters
+        :rtype: (np.array, np.array)
+        """
+        for token in self._tokens:
+            assert isinstance(token, str), "Only vocabularies of str can be converted to arrays"
+
+        offsets = np.zeros(len(self._tokens) + 1, dtype=OFFSET_DTYPE)
+        np.cumsum(np.fromiter(map(len, self._tokens), dtype=OFFSET_DTYPE, count=len(self._tokens)), out=offsets[1:])
+        return np.frombuffer("".join(self._tokens).encode("utf-8", "surrogatepass"), dtype=np.uint8), offsets
+
+    @classmethod
+    def from_arrays(cls, data, offsets):
+        """
+        Creates a vocabulary from the arrays returned by to_arrays
+        :rtype: Vocabulary
+        """
+        text = np.asarray(data).tobytes().decode("utf-8", "surrogatepass")
+        offsets = np.asarray(offsets).tolist()
+
+        vocabulary = cls()
+        vocabulary._tokens = [text[start:end] for start, end in zip(offsets, offsets[1:])]
+        vocabulary._ids = {token: token_id for token_id, token in enumerate(vocabulary._tokens)}
+        return vocabulary
+
+class EncodedMessages:
+    """
+    Tokenised messages in a ragged layout: the token ids of all messages concatenated into one flat array,
+    plus an array of offsets such that message i is ids[offsets[i]:offsets[i + 1]].
+    Iterating over it yields the messages decoded as lists of str, so it can be used wherever a list of tokenised
+    messages is expected, and is read directly as arrays where that is supported.
+    :ivar ids: token ids of all messages
+    :type ids: np.array
+    :ivar offsets: start of each message in ids, followed by the total number of ids. shape (n_messages + 1,)
+    :type offsets: np.array
+    :ivar vocabulary: vocabulary the ids refer to
+    :type vocabulary: Vocabulary
+    """
+    def __init__(self, ids, offsets, vocabulary):
+        ids = np.asarray(ids, dtype=ID_DTYPE)
+        offsets = np.asarray(offsets, dtype=OFFSET_DTYPE)
+        assert len(offsets) > 0 and offsets[0] == 0 and offsets[-1] == len(ids), "Offsets must span the ids from 0"
+
+        self.ids = ids
+        self.offsets = offsets
+        self.vocabulary = vocabulary
+
+    @classmethod
+    def encode(cls, messages, vocabulary=None):
+        """
+        Encodes tokenised messages, adding their tokens to the vocabulary
+        :type messages: iterable of list of str
+        :param vocabulary: vocabulary to encode with. A new one is created if None.
+        :type vocabulary: Vocabulary | None
+        :rtype: EncodedMessages
+        """
+        if vocabulary is None:
+            vocabulary = Vocabulary()
+
+        ids = array("i")
+        offsets = array("q", [0])
+        for message in messages:
+            ids.extend(map(vocabulary.add, message))
+            offsets.append(len(ids))
+
+        return cls(np.frombuffer(ids, dtype=ID_DTYPE), np.frombuffer(offsets, dtype=OFFSET_DTYPE), vocabulary)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.vocabulary.decode(self.get_ids(i))
+
+    def __iter__(self):
+        tokens = self.vocabulary.get_tokens()
+        offsets = self.offsets.tolist()
+        for start, end in zip(offsets, offsets[1:]):
+            yield [tokens[token_id] for token_id in self.ids[start:end].tolist()]
+
+    def get_ids(self, i):
+        """
+        :return: token ids of message i
+        :rtype: np.array
+        """
+        if i < 0:
+            i += len(self)
+        return self.ids[self.offsets[i]:self.offsets[i + 1]]
+
+    def get_lengths(self):
+        """
+        :return: number of tokens in each message
+        :rtype: np.array
+        """
+        return np.diff(self.offsets)
@@ -6,6 +6,6 @@ setup(
     url="https://github.com/AfricasVoices/CoreMLModules",
     packages=["core_ml_modules"],
     setup_requires=["pytest-runner"],
-    install_requires=["numpy", "scikit-learn", "nltk"],
+    install_requires=["numpy", "scipy", "scikit-learn"],
     tests_require=["pytest<=3.6.4"]
 )
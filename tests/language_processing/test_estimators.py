@@ -1,7 +1,14 @@
+import pickle
+import tempfile
 import unittest
 from collections import Counter
 
-from core_ml_modules.language_processing import estimators, Lexicon, model_utils
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction import FeatureHasher
+from sklearn.utils import murmurhash3_32
+
+from core_ml_modules.language_processing import estimators, Lexicon, EncodedMessages, model_utils
 
 MESSAGES = [
     ["I", "eat", "apples", "."],
@@ -31,6 +38,41 @@ class TestTokeniser(unittest.TestCase):
             tokeniser.fit(["I eat apples.", "abc!@#$def    ghi"]) == tokeniser
         )
 
+    def test_parallel_transform(self):
+        messages = ["I eat apples.", "abc!@#$def    ghi", "well-known (ok) ??", "", "it's & done"] * 7
+        expected = estimators.Tokeniser().transform(messages)
+
+        tokeniser = estimators.Tokeniser(n_jobs=2, chunk_size=3)
+        self.assertTrue(
+            tokeniser.transform(messages) == expected
+        )
+        self.assertTrue(
+            list(tokeniser.iter_transform(iter(messages))) == expected
+        )
+        self.assertTrue(
+            list(estimators.Tokeniser().iter_transform(iter(messages))) == expected
+        )
+
+    def test_deduplicate(self):
+        messages = ["yes", "I eat apples.", "yes", "thanks", "I eat apples."]
+        self.assertTrue(
+            estimators.Tokeniser(deduplicate=True).transform(messages) == estimators.Tokeniser().transform(messages)
+        )
+
+    def test_output_ids(self):
+        tokeniser = estimators.Tokeniser(output="ids")
+        encoded = tokeniser.transform(["I eat apples.", "I eat"])
+        self.assertTrue(encoded.ids.tolist() == [0, 1, 2, 3, 0, 1])
+        self.assertTrue(encoded.offsets.tolist() == [0, 4, 6])
+        self.assertTrue(list(encoded) == [["I", "eat", "apples", "."], ["I", "eat"]])
+
+        encoded = tokeniser.transform(["apples", "pears"])
+        self.assertTrue(encoded.ids.tolist() == [2, 4])     # Vocabulary is kept between calls
+        self.assertTrue(encoded.vocabulary is tokeniser.vocabulary_)
+
+        lexicon = Lexicon(encoded, FEATURES)
+        self.assertTrue(set(lexicon.get_words()) == {"apples", "pears"})
+
 class TestNGramFrequencyExtractor(unittest.TestCase):
     def test_retrieve_lexical_form(self):
         lexicon = Lexicon(MESSAGES, FEATURES)
@@ -47,6 +89,42 @@ class TestNGramFrequencyExtractor(unittest.TestCase):
             pos_extractor.retrieve_lexical_form(["I", "ate", "793", "oranges", "."]) == ["Noun", "Unk", "Num3", "Unk", "Punct"]
         )
 
+    def test_form_table(self):
+        lexicon = Lexicon(MESSAGES, FEATURES)
+        lexicon.set_feature_value("I", "pos_tag", "Noun")
+        lexicon.set_feature_value("eat", "pos_tag", "")
+
+        default_form_calls = []
+
+        def default_form(word, lexicon):
+            default_form_calls.append(word)
+            return model_utils.default_form_pos(word, lexicon)
+
+        extractor = estimators.NGramFrequencyExtractor(lexicon, form="pos_tag", default_form=default_form)
+        self.assertTrue(
+            extractor.retrieve_lexical_form(["I", "eat", "793", "793", "."]) == ["Noun", "Unk", "Num3", "Num3", "Punct"]
+        )
+        self.assertTrue(
+            extractor.retrieve_lexical_form(["793", "I"]) == ["Num3", "Noun"]
+        )
+        self.assertTrue(
+            default_form_calls == ["eat", "793", "."]   # Default forms are computed once per word
+        )
+
+        lexicon.set_feature_value("I", "pos_tag", "Pronoun")
+        lexicon.set_feature_value("eat", "pos_tag", "Verb")
+        self.assertTrue(
+            extractor.retrieve_lexical_form(["I", "eat", "793"]) == ["Pronoun", "Verb", "Num3"]
+        )
+
+        extractor.lexicon = Lexicon(MESSAGES, FEATURES)
+        self.assertTrue(
+            extractor.retrieve_lexical_form(["I", "eat"]) == ["Unk", "Unk"]
+        )
+
+        with self.assertRaises(AssertionError):
+            estimators.NGramFrequencyExtractor(lexicon, form="lemma").retrieve_lexical_form(["I"])
+
     def test_extract_frequency_dicts(self):
         lexicon = Lexicon(MESSAGES, FEATURES)
         extractor = estimators.NGramFrequencyExtractor(lexicon)
@@ -101,3 +179,435 @@ class TestNGramFrequencyExtractor(unittest.TestCase):
             extractor1.transform([["I", "eat", "oranges", "."]]).toarray().tolist() == [vector]
         )
 
+    def test_csr_engine(self):
+        lexicon = Lexicon(MESSAGES, FEATURES)
+        lexicon.set_feature_value("I", "pos_tag", "Noun")
+        messages = MESSAGES + [["I", "eat", "many", "many", "oranges", "."], ["a,b", "c"], ["a", "b,c"], ["I"], []]
+
+        for ngram_size in [1, 2, 3]:
+            for adjust_for_message_len in [True, False]:
+                for form, default_form in [(None, lambda word, lexicon: word), ("pos_tag", model_utils.default_form_pos)]:
+                    dict_extractor = estimators.NGramFrequencyExtractor(
+                        lexicon, form=form, default_form=default_form, ngram_size=ngram_size,
+                        adjust_for_message_len=adjust_for_message_len)
+                    csr_extractor = estimators.NGramFrequencyExtractor(
+                        lexicon, form=form, default_form=default_form, ngram_size=ngram_size,
+                        adjust_for_message_len=adjust_for_message_len, engine="csr")
+
+                    with self.assertRaises(AttributeError):
+                        csr_extractor.get_feature_names()
+
+                    expected = dict_extractor.fit_transform(messages).toarray()
+                    self.assertTrue(
+                        (csr_extractor.fit_transform(messages).toarray() == expected).all()
+                    )
+                    self.assertTrue(
+                        csr_extractor.get_feature_names() == dict_extractor.get_feature_names()
+                    )
+                    self.assertTrue(
+                        (csr_extractor.fit(MESSAGES).transform(messages).toarray() ==
+                         dict_extractor.fit(MESSAGES).transform(messages).toarray()).all()
+                    )
+
+    def test_hashing(self):
+        lexicon = Lexicon(MESSAGES, FEATURES)
+        messages = MESSAGES + [["I", "eat", "many", "many", "oranges", "."], ["I"], []]
+
+        for adjust_for_message_len in [True, False]:
+            dict_extractor = estimators.NGramFrequencyExtractor(lexicon, ngram_size=2,
+                                                                adjust_for_message_len=adjust_for_message_len)
+            hashing_extractor = estimators.NGramFrequencyExtractor(lexicon, ngram_size=2,
+                                                                   adjust_for_message_len=adjust_for_message_len,
+                                                                   n_features=2 ** 20, alternate_sign=False)
+
+            expected = dict_extractor.fit_transform(messages)
+            hashed = hashing_extractor.transform(messages)     # No fitting needed
+            self.assertTrue(hashed.shape == (len(messages), 2 ** 20))
+            for expected_row, hashed_row in zip(expected, hashed):
+                self.assertTrue(sorted(expected_row.data) == sorted(hashed_row.data))
+
+            self.assertTrue(
+                (hashing_extractor.partial_fit(MESSAGES).partial_fit(messages).transform(messages) != hashed).nnz == 0
+            )
+            self.assertTrue(
+                (hashing_extractor.fit_transform(messages) != hashed).nnz == 0
+            )
+
+        signed_extractor = estimators.NGramFrequencyExtractor(lexicon, n_features=2 ** 20)
+        self.assertTrue(
+            sorted(abs(signed_extractor.transform(MESSAGES).data)) == [0.25] * 8
+        )
+
+        with self.assertRaises(AttributeError):
+            signed_extractor.get_feature_names()
+        with self.assertRaises(AssertionError):
+            estimators.NGramFrequencyExtractor(lexicon).partial_fit(MESSAGES)
+
+    def test_ngram_range(self):
+        lexicon = Lexicon(MESSAGES, FEATURES)
+        extractor = estimators.NGramFrequencyExtractor(lexicon, ngram_range=(1, 2))
+
+        self.assertTrue(
+            extractor.extract_frequency_dicts([["I", "eat", "eat"]]) == [{
+                "I": 1/5, "eat": 2/5, "I,eat": 1/5, "eat,eat": 1/5
+            }]
+        )
+
+        extractor.fit(MESSAGES)
+        unigram_names = estimators.NGramFrequencyExtractor(lexicon, ngram_size=1).fit(MESSAGES).get_feature_names()
+        bigram_names = estimators.NGramFrequencyExtractor(lexicon, ngram_size=2).fit(MESSAGES).get_feature_names()
+        self.assertTrue(
+            extractor.get_feature_names() == sorted(unigram_names + bigram_names)
+        )
+
+        messages = MESSAGES + [["I", "eat", "many", "many", "oranges", "."], ["I"], []]
+        for ngram_range in [(1, 1), (1, 3), (2, 3)]:
+            dict_extractor = estimators.NGramFrequencyExtractor(lexicon, ngram_range=ngram_range)
+            csr_extractor = estimators.NGramFrequencyExtractor(lexicon, ngram_range=ngram_range, engine="csr")
+            hashing_extractor = estimators.NGramFrequencyExtractor(lexicon, ngram_range=ngram_range,
+                                                                   n_features=2 ** 20, alternate_sign=False)
+
+            expected = dict_extractor.fit_transform(messages)
+            self.assertTrue(
+                (csr_extractor.fit_transform(messages) != expected).nnz == 0
+            )
+            for expected_row, hashed_row in zip(expected, hashing_extractor.transform(messages)):
+                self.assertTrue(sorted(expected_row.data) == sorted(hashed_row.data))
+
+        with self.assertRaises(AssertionError):
+            estimators.NGramFrequencyExtractor(lexicon, ngram_range=(2, 1)).fit(MESSAGES)
+
+    def test_deduplicate(self):
+        lexicon = Lexicon(MESSAGES, FEATURES)
+        messages = [["I", "eat", "apples", "."], ["yes"], ["I", "eat", "apples", "."], ["yes"], ["thanks"], ["yes"]]
+
+        for params in [{}, {"engine": "csr"}, {"n_features": 2 ** 10}]:
+            extractor = estimators.NGramFrequencyExtractor(lexicon, ngram_range=(1, 2), **params)
+            deduplicating_extractor = estimators.NGramFrequencyExtractor(lexicon, ngram_range=(1, 2), deduplicate=True,
+                                                                         **params)
+
+            expected = extractor.fit_transform(messages)
+            self.assertTrue(
+                (deduplicating_extractor.fit_transform(messages) != expected).nnz == 0
+            )
+            self.assertTrue(
+                (deduplicating_extractor.fit(messages).transform(messages) != expected).nnz == 0
+            )
+            self.assertTrue(
+                deduplicating_extractor.extract_frequency_dicts(messages) == extractor.extract_frequency_dicts(messages)
+            )
+
+    def test_encoded_messages(self):
+        lexicon = Lexicon(MESSAGES, FEATURES)
+        lexicon.set_feature_value("I", "pos_tag", "Noun")
+        messages = MESSAGES + [["I", "eat", "many", "many", "oranges", "."], ["I"], [], ["a,b", "c"], ["a", "b,c"]]
+        encoded = EncodedMessages.encode(messages)
+
+        for ngram_range in [(1, 1), (2, 2), (1, 3)]:
+            for adjust_for_message_len in [True, False]:
+                for form, default_form in [(None, lambda word, lexicon: word), ("pos_tag", model_utils.default_form_pos)]:
+                    for params in [{"engine": "csr"}, {"n_features": 2 ** 10}, {"n_features": 2 ** 10, "alternate_sign": False}]:
+                        extractor = estimators.NGramFrequencyExtractor(
+                            lexicon, form=form, default_form=default_form, ngram_range=ngram_range,
+                            adjust_for_message_len=adjust_for_message_len, **params)
+
+                        expected = extractor.fit_transform(messages)
+                        self.assertTrue(
+                            abs(extractor.fit_transform(encoded) - expected).max() == 0
+                        )
+                        self.assertTrue(
+                            abs(extractor.fit(messages).transform(encoded) - expected).max() == 0
+                        )
+
+
+    def test_partial_fit(self):
+        lexicon = Lexicon(MESSAGES, FEATURES)
+        messages = MESSAGES + [["I", "eat", "many", "many", "oranges", "."], ["I"], [], ["a,b", "c"], ["a", "b,c"]]
+
+        for ngram_range in [(1, 1), (1, 2)]:
+            batches = [messages[:2], iter(messages[2:4]), EncodedMessages.encode(messages[4:])]
+            extractor = estimators.NGramFrequencyExtractor(lexicon, engine="csr", ngram_range=ngram_range)
+            expected = extractor.fit_transform(messages)
+            expected_feature_names = extractor.get_feature_names()
+
+            streaming_extractor = estimators.NGramFrequencyExtractor(lexicon, engine="csr", ngram_range=ngram_range)
+            streaming_extractor.partial_fit(batches[0])
+            first_feature_names = streaming_extractor.get_feature_names()
+            for batch in batches[1:]:
+                streaming_extractor.partial_fit(batch)
+            feature_names = streaming_extractor.get_feature_names()
+
+            # Columns of ngrams seen in earlier batches do not move
+            self.assertTrue(
+                feature_names[:len(first_feature_names)] == first_feature_names
+            )
+            self.assertTrue(
+                sorted(feature_names) == expected_feature_names
+            )
+            permutation = [expected_feature_names.index(name) for name in feature_names]
+            self.assertTrue(
+                abs(streaming_extractor.transform(messages) - expected[:, permutation]).max() == 0
+            )
+
+            # fit only iterates over its input once
+            dict_extractor = estimators.NGramFrequencyExtractor(lexicon, ngram_range=ngram_range)
+            self.assertTrue(
+                dict_extractor.fit(iter(messages)).get_feature_names() == expected_feature_names
+            )
+
+        with self.assertRaises(AssertionError):
+            estimators.NGramFrequencyExtractor(lexicon).partial_fit(messages)
+
+    def test_prune_vocabulary(self):
+        lexicon = Lexicon(MESSAGES, FEATURES)
+        messages = MESSAGES + [["I", "eat", "many", "many", "oranges", "."], ["I", "eat"], [], ["You", "eat", "."]]
+        document_frequencies = Counter(name for message in messages
+                                       for name in {",".join(ngram) for ngram in zip(message, message[1:])} |
+                                       set(message))
+
+        for params, expected_names in [
+            ({"min_df": 2}, {name for name, df in document_frequencies.items() if df >= 2}),
+            ({"min_df": 0.5}, {name for name, df in document_frequencies.items() if df >= 3}),
+            ({"max_df": 0.5}, {name for name, df in document_frequencies.items() if df <= 3}),
+            ({"max_df": 1}, {name for name, df in document_frequencies.items() if df == 1}),
+            ({"max_features": 3}, {"eat", "I", "."}),
+            ({"min_df": 2, "max_df": 4, "max_features": 4}, {".", "I", "I,eat", "You"})
+        ]:
+            for engine in ["dict", "csr"]:
+                extractor = estimators.NGramFrequencyExtractor(lexicon, engine=engine, ngram_range=(1, 2), **params)
+                matrix = extractor.fit_transform(messages)
+                feature_names = extractor.get_feature_names()
+                self.assertTrue(
+                    feature_names == sorted(expected_names)
+                )
+
+                unpruned_extractor = estimators.NGramFrequencyExtractor(lexicon, engine=engine, ngram_range=(1, 2))
+                unpruned_matrix = unpruned_extractor.fit_transform(messages)
+                unpruned_feature_names = unpruned_extractor.get_feature_names()
+                columns = [unpruned_feature_names.index(name) for name in feature_names]
+                self.assertTrue(
+                    abs(matrix - unpruned_matrix[:, columns]).max() == 0
+                )
+                self.assertTrue(
+                    extractor.fit(EncodedMessages.encode(messages)).get_feature_names() == feature_names
+                )
+
+                # Pruning reads the messages twice, so they cannot be an iterator
+                with self.assertRaises(AssertionError):
+                    extractor.fit_transform(iter(messages))
+                with self.assertRaises(AssertionError):
+                    estimators.TextNGramFrequencyExtractor(lexicon, min_df=2).fit_transform(iter(["I eat", "I eat"]))
+
+        with self.assertRaises(AssertionError):
+            estimators.NGramFrequencyExtractor(lexicon, n_features=2 ** 10, min_df=2)
+
+    def test_prune_vocabulary_saturated_sketch(self):
+        # A sketch with a handful of counters per row overestimates the document frequency of nearly every ngram,
+        # so all of them become candidates, and only the exact second pass prunes them
+        rng = np.random.default_rng(0)
+        words = ["w{}".format(i) for i in range(300)]
+        messages = [[str(word) for word in rng.choice(words, size=4)] + ["common"] for _ in range(500)]
+        lexicon = Lexicon(messages, [])
+        document_frequencies = Counter(name for message in messages
+                                       for name in {",".join(ngram) for ngram in zip(message, message[1:])} |
+                                       set(message))
+
+        for params, expected_names in [
+            ({"min_df": 5}, {name for name, df in document_frequencies.items() if df >= 5}),
+            ({"min_df": 2, "max_df": 0.5}, {name for name, df in document_frequencies.items() if 2 <= df <= 250}),
+            ({"max_features": 10}, set(sorted(sorted(document_frequencies),
+                                              key=lambda name: -document_frequencies[name])[:10]))
+        ]:
+            extractor = estimators.NGramFrequencyExtractor(lexicon, engine="csr", ngram_range=(1, 2), **params)
+            extractor.SKETCH_WIDTH = extractor.MAX_SKETCH_WIDTH = 8
+            self.assertTrue(extractor._get_sketch_width(messages) == 8)
+            self.assertTrue(
+                extractor.fit(messages).get_feature_names() == sorted(expected_names)
+            )
+
+    def test_save_load(self):
+        lexicon = Lexicon(MESSAGES, FEATURES)
+        lexicon.set_feature_values("pos_tag", {"I": "Noun", "eat": "Verb", "apples": "Noun", "You": ""})
+        # Includes names differing only by trailing NULs, which numpy byte strings drop, and lone surrogates
+        all_messages = MESSAGES + [["I", "eat", "many", "many", "oranges", "."], ["I"], [], ["a,b", "c"], ["a", "b,c"],
+                                   ["a\x00"], ["a", "\x00", "\x00"], ["\ud800", "a"], ["épée", "naïve", "42"]]
+
+        # The default extractor no longer holds a lambda, so it can be pickled
+        pickle.loads(pickle.dumps(estimators.NGramFrequencyExtractor(lexicon)))
+
+        for form, default_form in [(None, model_utils.default_form_word), ("pos_tag", model_utils.default_form_pos)]:
+            for params in [{}, {"engine": "csr", "ngram_range": (1, 2)}, {"n_features": 2 ** 10},
+                           {"engine": "csr", "deduplicate": True, "adjust_for_message_len": False}]:
+                extractor = estimators.NGramFrequencyExtractor(lexicon, form=form, default_form=default_form, **params)
+                # Only feature names are saved in hashing mode, whose FeatureHasher cannot hash lone surrogates
+                messages = all_messages if "n_features" not in params else \
+                    [message for message in all_messages if "\ud800" not in message]
+                if params.get("engine") == "csr":
+                    # Feature names are not sorted after partial_fit
+                    extractor.partial_fit(messages[2:]).partial_fit(messages[:2])
+                else:
+                    extractor.fit(messages[:-1])
+                expected = extractor.transform(messages)
+
+                with tempfile.TemporaryDirectory() as path:
+                    extractor.save(path)
+                    for mmap in [True, False]:
+                        loaded = estimators.NGramFrequencyExtractor.load(path, mmap=mmap)
+                        self.assertTrue(loaded.lexicon is None)
+                        self.assertTrue(loaded.get_params()["ngram_range"] == extractor.ngram_range)
+                        self.assertTrue(
+                            abs(loaded.transform(messages) - expected).max() == 0
+                        )
+                        self.assertTrue(
+                            abs(loaded.transform(EncodedMessages.encode(messages)) - expected).max() == 0
+                        )
+                        if extractor.n_features is None:
+                            self.assertTrue(
+                                loaded.get_feature_names() == extractor.get_feature_names()
+                            )
+
+        with self.assertRaises(AssertionError):
+            extractor = estimators.NGramFrequencyExtractor(lexicon, default_form=lambda word, lexicon: word)
+            extractor.fit(all_messages).save("")
+
+    def test_dtype_norm(self):
+        lexicon = Lexicon(MESSAGES, FEATURES)
+        messages = MESSAGES + [["I", "eat", "many", "many", "oranges", "."], ["I"], [], ["a,b", "c"], ["a", "b,c"]]
+
+        for params in [{}, {"engine": "csr"}, {"n_features": 2 ** 10, "alternate_sign": False}]:
+            for adjust_for_message_len in [True, False]:
+                expected = estimators.NGramFrequencyExtractor(
+                    lexicon, ngram_range=(1, 2), adjust_for_message_len=adjust_for_message_len, **params
+                ).fit_transform(messages)
+
+                for norm in [None, "l1", "l2"]:
+                    extractor = estimators.NGramFrequencyExtractor(
+                        lexicon, ngram_range=(1, 2), adjust_for_message_len=adjust_for_message_len, dtype=np.float32,
+                        norm=norm, **params)
+                    matrix = extractor.fit_transform(messages)
+                    self.assertTrue(matrix.dtype == np.float32)
+                    self.assertTrue(extractor.transform(messages).dtype == np.float32)
+                    self.assertTrue(extractor.transform(EncodedMessages.encode(messages)).dtype == np.float32)
+
+                    expected_matrix = expected
+                    if norm == "l1":
+                        expected_matrix = sp.diags(1 / np.maximum(abs(expected).sum(axis=1).A.ravel(), 1e-12)) @ expected
+                    elif norm == "l2":
+                        expected_matrix = sp.diags(
+                            1 / np.maximum(np.sqrt(expected.multiply(expected).sum(axis=1).A.ravel()), 1e-12)) @ expected
+                    self.assertTrue(
+                        abs(matrix - expected_matrix).max() < 1e-6
+                    )
+                    self.assertTrue(
+                        abs(extractor.transform(EncodedMessages.encode(messages)) - matrix).max() < 1e-6
+                    )
+
+        with self.assertRaises(AssertionError):
+            estimators.NGramFrequencyExtractor(lexicon, norm="max")
+
+    def test_text_ngram_frequency_extractor(self):
+        lexicon = Lexicon(MESSAGES, FEATURES)
+        lexicon.set_feature_values("pos_tag", {"I": "Noun", "eat": "Verb", "apples": "Noun"})
+        raw_messages = ["I eat apples.", "You eat bananas?", "I eat apples.", "", "well-known 42 :) :)", "I don't eat"]
+        tokenised_messages = estimators.Tokeniser().transform(raw_messages)
+
+        for form, default_form in [(None, model_utils.default_form_word), ("pos_tag", model_utils.default_form_pos)]:
+            for params in [{}, {"engine": "csr", "ngram_range": (1, 2)}, {"n_features": 2 ** 10},
+                           {"engine": "csr", "deduplicate": True}, {"deduplicate": True, "min_df": 2}]:
+                extractor = estimators.NGramFrequencyExtractor(lexicon, form=form, default_form=default_form, **params)
+                text_extractor = estimators.TextNGramFrequencyExtractor(lexicon, form=form, default_form=default_form,
+                                                                        **params)
+                self.assertTrue(text_extractor.get_params() == extractor.get_params())
+
+                expected = extractor.fit_transform(tokenised_messages)
+                self.assertTrue(
+                    abs(text_extractor.fit_transform(raw_messages) - expected).max() == 0
+                )
+                # Pruning reads the messages twice, so they cannot be an iterator
+                fit_messages = raw_messages if text_extractor._is_pruning() else iter(raw_messages)
+                self.assertTrue(
+                    abs(text_extractor.fit(fit_messages).transform(iter(raw_messages)) - expected).max() == 0
+                )
+                if extractor.n_features is None:
+                    self.assertTrue(
+                        text_extractor.get_feature_names() == extractor.get_feature_names()
+                    )
+                self.assertTrue(
+                    text_extractor.extract_frequency_dicts(raw_messages) ==
+                    extractor.extract_frequency_dicts(tokenised_messages)
+                )
+
+class TestCharNGramFrequencyExtractor(unittest.TestCase):
+    @staticmethod
+    def count_char_ngrams(message, ngram_range):
+        counts = Counter()
+        for n in range(ngram_range[0], ngram_range[1] + 1):
+            for i in range(len(message) - n + 1):
+                counts[message[i:i + n]] += 1
+        return counts
+
+    def test_fit_transform(self):
+        raw_messages = ["habari yako", "", "ndiyo 😀 asante", "a", "niño ñaña", "habari yako", "ab\x00", "b",
+                        "\x00\x00", "lone \ud83d surrogate"]
+
+        for ngram_range in [(1, 1), (2, 5), (3, 3)]:
+            extractor = estimators.CharNGramFrequencyExtractor(ngram_range=ngram_range, chunk_size=4)
+            matrix = extractor.fit_transform(raw_messages)
+            feature_names = extractor.get_feature_names()
+            self.assertTrue(feature_names == sorted(feature_names))
+
+            for i, message in enumerate(raw_messages):
+                counts = self.count_char_ngrams(message, ngram_range)
+                row = matrix.getrow(i)
+                self.assertTrue(
+                    {feature_names[column]: value for column, value in zip(row.indices, row.data)} ==
+                    {ngram: count / sum(counts.values()) for ngram, count in counts.items()}
+                )
+
+            fitted = estimators.CharNGramFrequencyExtractor(ngram_range=ngram_range, chunk_size=3)
+            fitted.fit(iter(raw_messages))
+            self.assertTrue(fitted.get_feature_names() == feature_names)
+            self.assertTrue(abs(fitted.transform(iter(raw_messages)) - matrix).max() == 0)
+
+        extractor = estimators.CharNGramFrequencyExtractor(ngram_range=(1, 2), adjust_for_message_len=False)
+        extractor.fit(["abab"])
+        self.assertTrue(extractor.get_feature_names() == ["a", "ab", "b", "ba"])
+        self.assertTrue(extractor.transform(["abab", "abc", ""]).toarray().tolist() ==
+                        [[2, 2, 2, 1], [1, 1, 1, 0], [0, 0, 0, 0]])
+
+    def test_partial_fit(self):
+        extractor = estimators.CharNGramFrequencyExtractor(ngram_range=(1, 1), adjust_for_message_len=False)
+        extractor.partial_fit(["ba"])
+        extractor.partial_fit(["cab"])
+        self.assertTrue(extractor.get_feature_names() == ["a", "b", "c"])
+        extractor.partial_fit(["dab"])
+        self.assertTrue(extractor.get_feature_names() == ["a", "b", "c", "d"])
+        self.assertTrue(extractor.transform(["add"]).toarray().tolist() == [[1, 0, 0, 2]])
+
+    def test_hashing(self):
+        raw_messages = ["habari yako", "", "ndiyo 😀 asante"]
+        extractor = estimators.CharNGramFrequencyExtractor(ngram_range=(2, 3), n_features=2 ** 10,
+                                                           adjust_for_message_len=False)
+        matrix = extractor.fit_transform(raw_messages)
+        self.assertTrue(matrix.shape == (3, 2 ** 10))
+
+        hasher = FeatureHasher(n_features=2 ** 10, input_type="dict")
+        expected = hasher.transform(self.count_char_ngrams(message, (2, 3)) for message in raw_messages)
+        self.assertTrue(abs(matrix - expected).max() == 0)
+
+        with self.assertRaises(AttributeError):
+            extractor.get_feature_names()
+
+        # The FeatureHasher cannot hash lone surrogates, so their columns are checked against their UTF-8 bytes
+        matrix = extractor.transform(["lone \ud83d surrogate"])
+        expected = np.zeros(2 ** 10)
+        for ngram, count in self.count_char_ngrams("lone \ud83d surrogate", (2, 3)).items():
+            ngram_hash = murmurhash3_32(ngram.encode("utf-8", "surrogatepass"), seed=0)
+            expected[abs(ngram_hash) % 2 ** 10] += count if ngram_hash >= 0 else -count
+        self.assertTrue(np.array_equal(matrix.toarray()[0], expected))
+
+    def test_dtype_norm(self):
+        raw_messages = ["habari yako", "ndiyo asante"]
+        matrix = estimators.CharNGramFrequencyExtractor(dtype=np.float32, norm="l2").fit_transform(raw_messages)
+        self.assertTrue(matrix.dtype == np.float32)
+        self.assertTrue(np.allclose(np.sqrt(matrix.multiply(matrix).sum(axis=1)).ravel(), 1))
@@ -1,6 +1,10 @@
+import os
+import tempfile
 import unittest
 
-from core_ml_modules.language_processing import Lexicon
+import numpy as np
+
+from core_ml_modules.language_processing import Lexicon, EncodedMessages, WordSet
 
 MESSAGES = [
     ["I", "eat", "apples", "."],
@@ -65,3 +69,365 @@ class TestLexicon(unittest.TestCase):
         )
         with self.assertRaises(AssertionError):
             lexicon.get_messages_by_word("They")    # Words in separately added messages are not automatically added to lexicon
+
+    def test_postings(self):
+        messages = [
+            ["yes", "yes", "yes"],
+            ["no"],
+            ["yes", "no", "maybe"],
+            ["maybe", "yes"]
+        ]
+
+        for lexicon in [Lexicon(messages, FEATURES), Lexicon(EncodedMessages.encode(messages), FEATURES)]:
+            self.assertTrue(
+                lexicon.get_message_ids_by_word("yes").tolist() == [0, 2, 3]     # Sorted, without duplicates
+            )
+            self.assertTrue(
+                lexicon.get_messages_by_word("maybe") == [messages[2], messages[3]]
+            )
+            self.assertTrue(
+                lexicon.get_message_ids_with_all_words(["yes", "maybe"]).tolist() == [2, 3]
+            )
+            self.assertTrue(
+                lexicon.get_message_ids_with_all_words(["yes", "maybe", "no"]).tolist() == [2]
+            )
+            self.assertTrue(
+                lexicon.get_message_ids_with_any_words(["no", "maybe"]).tolist() == [1, 2, 3]
+            )
+            self.assertTrue(
+                lexicon.get_message_ids_with_any_words([]).tolist() == []
+            )
+            self.assertTrue(
+                lexicon.get_document_frequency("yes") == 3
+            )
+            self.assertTrue(
+                lexicon.get_document_frequencies(["no", "maybe", "yes"]).tolist() == [2, 2, 3]
+            )
+            self.assertTrue(
+                dict(zip(lexicon.get_words(), lexicon.get_document_frequencies().tolist())) == {"yes": 3, "no": 2, "maybe": 2}
+            )
+
+            lexicon.add_word("perhaps")
+            lexicon.add_message_to_word("perhaps", ["perhaps", "not"])
+            lexicon.add_message_to_word("maybe", ["maybe", "yes"])
+            self.assertTrue(
+                lexicon.get_message_ids_by_word("perhaps").tolist() == [4]
+            )
+            self.assertTrue(
+                lexicon.get_message_ids_by_word("maybe").tolist() == [2, 3, 5]
+            )
+            self.assertTrue(
+                lexicon.get_message_ids_by_word("yes").tolist() == [0, 2, 3]    # Only the word provided is indexed
+            )
+            self.assertTrue(
+                lexicon.get_messages([4, 0]) == [["perhaps", "not"], ["yes", "yes", "yes"]]
+            )
+
+        lexicon = Lexicon([], FEATURES)
+        lexicon.add_word("x")
+        self.assertTrue(
+            lexicon.get_messages_by_word("x") == []      # Words without postings, in a lexicon without any
+        )
+
+    def test_feature_index(self):
+        lexicon = Lexicon(MESSAGES, FEATURES)
+        lexicon.set_feature_value("I", "pos_tag", "noun")
+        lexicon.set_feature_value("apples", "pos_tag", "noun")
+        lexicon.set_feature_value("eat", "canonical_form", "noun")
+        self.assertTrue(
+            lexicon.get_words_by_feature_value("pos_tag", "noun") == ["I", "apples"]
+        )
+        self.assertTrue(
+            lexicon.get_words_by_feature_value("canonical_form", "noun") == ["eat"]    # Features are indexed separately
+        )
+
+        lexicon.set_feature_value("I", "pos_tag", "pronoun")
+        self.assertTrue(
+            lexicon.get_words_by_feature_value("pos_tag", "noun") == ["apples"]     # No stale entries when changed
+        )
+        self.assertTrue(
+            lexicon.get_words_by_feature_value("pos_tag", "pronoun") == ["I"]
+        )
+
+    def test_feature_values_by_word(self):
+        lexicon = Lexicon(MESSAGES, FEATURES)
+        version = lexicon.get_version()
+        lexicon.set_feature_value("I", "pos_tag", "pronoun")
+        lexicon.set_feature_value("apples", "pos_tag", "noun")
+        lexicon.set_feature_value("eat", "canonical_form", "eat")
+        self.assertTrue(lexicon.get_version() != version)
+        self.assertTrue(
+            lexicon.get_feature_values_by_word("pos_tag") == {"I": "pronoun", "apples": "noun"}
+        )
+
+    def test_set_feature_values(self):
+        lexicon = Lexicon(MESSAGES, FEATURES)
+        lexicon.set_feature_value("bananas", "pos_tag", "verb")
+        version = lexicon.get_version()
+        lexicon.set_feature_values("pos_tag", {"I": "pronoun", "apples": "noun", "bananas": "noun"})
+        self.assertTrue(lexicon.get_version() != version)
+        self.assertTrue(
+            lexicon.get_feature_values_by_word("pos_tag") == {"I": "pronoun", "apples": "noun", "bananas": "noun"}
+        )
+        self.assertTrue(
+            lexicon.get_words_by_feature_value("pos_tag", "noun") == ["apples", "bananas"]
+        )
+        self.assertTrue(
+            lexicon.get_words_by_feature_value("pos_tag", "verb") == []
+        )
+
+        lexicon.set_feature_values("pos_tag", ["eat", "I", "eat", "apples"], ["noun", None, "verb", "noun"])
+        self.assertTrue(
+            lexicon.get_feature_values_by_word("pos_tag") == {"eat": "verb", "apples": "noun", "bananas": "noun"}
+        )
+        self.assertTrue(
+            lexicon.get_words_by_feature_value("pos_tag", "noun") == ["apples", "bananas"]
+        )
+
+        with self.assertRaises(AssertionError):
+            lexicon.set_feature_values("pos_tag", {"pears": "noun"})
+        with self.assertRaises(AssertionError):
+            lexicon.set_feature_values("pos_tag", ["eat"], ["verb", "noun"])
+
+    def test_select_words(self):
+        lexicon = Lexicon(MESSAGES + [["They", "ate", "oranges", "!"]], FEATURES)
+        lexicon.set_feature_values("pos_tag", {"I": "pronoun", "You": "pronoun", "They": "pronoun",
+                                               "apples": "noun", "bananas": "noun", "oranges": "noun",
+                                               "eat": "verb", "ate": "verb"})
+        lexicon.set_feature_values("canonical_form", {"apples": "apple", "oranges": "orange", "ate": "eat"})
+
+        nouns = lexicon.select_words("pos_tag", "noun")
+        fruit = lexicon.select_words("canonical_form", {"apple", "orange", "pear"})
+        self.assertTrue(isinstance(nouns, WordSet))
+        self.assertTrue(
+            (nouns & fruit).get_words() == ["apples", "oranges"]
+        )
+        self.assertTrue(
+            (nouns - fruit).get_words() == ["bananas"]
+        )
+        self.assertTrue(
+            len(nouns | lexicon.select_words("pos_tag", ["verb", "adjective"])) == 5
+        )
+        self.assertTrue(
+            list(~lexicon.select_words("pos_tag", ["noun", "pronoun", "verb"])) == [".", "?", "!"]
+        )
+        self.assertTrue("apples" in nouns and "eat" not in nouns and "pears" not in nouns)
+        self.assertTrue(
+            len(lexicon.select_words("pos_tag", "adjective")) == 0
+        )
+
+        # New selections reflect changes made to the lexicon, and can be combined with older ones
+        lexicon.set_feature_value("bananas", "canonical_form", "banana")
+        lexicon.add_word("pears")
+        lexicon.set_feature_value("pears", "pos_tag", "noun")
+        self.assertTrue(
+            (lexicon.select_words("pos_tag", "noun") - lexicon.select_words("canonical_form", "apple")).get_words()
+            == ["bananas", "oranges", "pears"]
+        )
+        self.assertTrue(
+            (nouns | lexicon.select_words("pos_tag", "noun")).get_words() == ["apples", "bananas", "oranges", "pears"]
+        )
+        self.assertTrue(
+            len(lexicon.get_word_set()) == len(lexicon.get_words())
+        )
+
+    def test_cooccurrence(self):
+        messages = MESSAGES + [["They", "ate", "oranges", "!"], ["I", "eat", "eat", "oranges"], []]
+        lexicon = Lexicon(messages, FEATURES)
+        lexicon.add_word("pears")
+        words = lexicon.get_words()
+
+        incidence = lexicon.get_incidence_matrix()
+        self.assertTrue(incidence.shape == (len(words), len(messages)))
+        self.assertTrue(
+            (incidence.toarray() == [[word in message for message in messages] for word in words]).all()
+        )
+        self.assertTrue(
+            (np.asarray(incidence.sum(axis=1)).ravel() == lexicon.get_document_frequencies()).all()
+        )
+
+        cooccurrences = lexicon.get_cooccurrence_matrix()
+        self.assertTrue(
+            (cooccurrences.toarray() == [[sum(a in message and b in message for message in messages) for b in words]
+                                         for a in words]).all()
+        )
+
+        for window in [1, 2, 10]:
+            expected = np.zeros((len(words), len(words)), dtype=int)
+            for message in messages:
+                for i, a in enumerate(message):
+                    for b in message[i + 1:i + 1 + window]:
+                        expected[words.index(a), words.index(b)] += 1
+                        if a != b:
+                            expected[words.index(b), words.index(a)] += 1
+            self.assertTrue(
+                (lexicon.get_cooccurrence_matrix(window).toarray() == expected).all()
+            )
+
+    def test_save_load(self):
+        lexicon = Lexicon(MESSAGES, FEATURES)
+        lexicon.set_feature_value("I", "pos_tag", "pronoun")
+        lexicon.set_feature_value("apples", "canonical_form", "apple")
+        lexicon.add_word("oranges")
+        lexicon.add_message_to_word("oranges", ["They", "ate", "oranges", "!"])
+
+        with tempfile.TemporaryDirectory() as path:
+            lexicon.save(os.path.join(path, "lexicon"))
+
+            for mmap in [True, False]:
+                loaded = Lexicon.load(os.path.join(path, "lexicon"), mmap=mmap)
+                self.assertTrue(
+                    loaded.get_words() == lexicon.get_words()
+                )
+                self.assertTrue(
+                    set(loaded.get_features()) == set(FEATURES)
+                )
+                self.assertTrue("They" not in loaded)
+                self.assertTrue(
+                    loaded.get_feature_value_by_word("I", "pos_tag") == "pronoun"
+                )
+                self.assertTrue(
+                    loaded.get_feature_value_by_word("eat", "pos_tag") is None
+                )
+                self.assertTrue(
+                    loaded.get_words_by_feature_value("canonical_form", "apple") == ["apples"]
+                )
+                self.assertTrue(
+                    loaded.get_messages_by_word("eat") == MESSAGES
+                )
+                self.assertTrue(
+                    loaded.get_messages_by_word("oranges") == [["They", "ate", "oranges", "!"]]
+                )
+
+                # Loaded lexicons can still be modified, without changing the saved files
+                loaded.set_feature_value("eat", "pos_tag", "verb")
+                loaded.add_word("pears")
+                loaded.add_message_to_word("pears", ["pears", "!"])
+                self.assertTrue(
+                    loaded.get_feature_value_by_word("eat", "pos_tag") == "verb"
+                )
+                self.assertTrue(
+                    loaded.get_messages_by_word("pears") == [["pears", "!"]]
+                )
+
+            reloaded = Lexicon.load(os.path.join(path, "lexicon"))
+            self.assertTrue("pears" not in reloaded)
+
+            # Tokens can contain lone surrogates, which are valid in a str but not in UTF-8
+            surrogate_lexicon = Lexicon([["\ud800", "a\x00"]], [])
+            surrogate_lexicon.save(os.path.join(path, "surrogates"))
+            self.assertTrue(
+                Lexicon.load(os.path.join(path, "surrogates")).get_words() == ["\ud800", "a\x00"]
+            )
+            self.assertTrue(
+                reloaded.get_feature_value_by_word("eat", "pos_tag") is None
+            )
+
+    def test_streaming(self):
+        messages = MESSAGES + [["They", "ate", "oranges", "!"], ["I", "eat", "eat", "oranges"]]
+
+        lexicon = Lexicon(iter(messages[:1]), FEATURES)
+        lexicon.update(message for message in messages[1:3])
+        lexicon.update(EncodedMessages.encode(messages[3:]))
+        self.assertTrue(
+            lexicon.get_words() == Lexicon(messages, FEATURES).get_words()
+        )
+        self.assertTrue(
+            lexicon.get_messages_by_word("oranges") == messages[2:]
+        )
+
+        for chunk_size in [1, 3, 10]:
+            streamed = Lexicon([], FEATURES, store_messages=False)
+            streamed.CHUNK_SIZE = chunk_size
+            streamed.update(iter(messages))
+            self.assertTrue(
+                streamed.get_words() == lexicon.get_words()
+            )
+            self.assertTrue(
+                (streamed.get_document_frequencies() == lexicon.get_document_frequencies()).all()
+            )
+            self.assertTrue(
+                streamed.get_document_frequency("eat") == 3
+            )
+            with self.assertRaises(AssertionError):
+                streamed.get_messages_by_word("eat")
+
+        streamed.add_message_to_word("eat", ["eat"])
+        self.assertTrue(
+            streamed.get_document_frequency("eat") == 4
+        )
+
+        with tempfile.TemporaryDirectory() as path:
+            streamed.save(path)
+            loaded = Lexicon.load(path)
+            self.assertTrue(
+                loaded.get_document_frequency("eat") == 4
+            )
+            loaded.update([["eat", "pears"]])
+            self.assertTrue(
+                loaded.get_document_frequency("eat") == 5 and loaded.get_document_frequency("pears") == 1
+            )
+
+    def test_merge(self):
+        messages = MESSAGES + [["They", "ate", "oranges", "!"], ["I", "eat", "eat", "oranges"], [], ["pears"]]
+        expected = Lexicon(messages, FEATURES)
+
+        shards = [Lexicon(messages[:2], FEATURES), Lexicon(messages[2:3], ["pos_tag"]),
+                  Lexicon(messages[3:], ["canonical_form"])]
+        shards[0].set_feature_value("I", "pos_tag", "noun")
+        shards[0].set_feature_value("eat", "pos_tag", "verb")
+        shards[0].set_feature_value("apples", "canonical_form", "apple")
+        shards[1].set_feature_value("They", "pos_tag", "pronoun")
+        shards[2].set_feature_value("I", "canonical_form", "I")
+        shards[2].add_word("grapes")
+        shards[2].set_feature_value("I", "canonical_form", "i")
+
+        # A later shard overrides the values set by earlier ones
+        shards.append(Lexicon([], ["pos_tag"]))
+        shards[-1].add_word("I")
+        shards[-1].set_feature_value("I", "pos_tag", "pronoun")
+
+        merged = Lexicon.merge(shards)
+        self.assertTrue(
+            merged.get_words() == expected.get_words() + ["grapes"]
+        )
+        self.assertTrue(
+            list(merged.get_features()) == FEATURES
+        )
+        self.assertTrue(
+            merged.get_words_by_feature_value("pos_tag", "pronoun") == ["I", "They"]
+        )
+        self.assertTrue(
+            merged.get_feature_values_by_word("canonical_form") == {"I": "i", "apples": "apple"}
+        )
+        for word in expected.get_words():
+            self.assertTrue(
+                (merged.get_message_ids_by_word(word) == expected.get_message_ids_by_word(word)).all()
+            )
+        self.assertTrue(
+            merged.get_messages(range(len(messages))) == messages
+        )
+
+        counting_shard = Lexicon(messages[3:], [], store_messages=False)
+        counted = Lexicon.merge([Lexicon(messages[:3], FEATURES), counting_shard])
+        self.assertTrue(
+            (counted.get_document_frequencies() == expected.get_document_frequencies()).all()
+        )
+        with self.assertRaises(AssertionError):
+            counted.get_messages([0])
+
+    def test_build(self):
+        messages = MESSAGES + [["They", "ate", "oranges", "!"], ["I", "eat", "eat", "oranges"], [], ["pears"]]
+        expected = Lexicon(messages, FEATURES)
+
+        for store_messages in [False, True]:
+            lexicon = Lexicon.build(iter(messages), FEATURES, n_jobs=2, shard_size=2, store_messages=store_messages)
+            self.assertTrue(
+                lexicon.get_words() == expected.get_words()
+            )
+            self.assertTrue(
+                (lexicon.get_document_frequencies() == expected.get_document_frequencies()).all()
+            )
+        self.assertTrue(
+            lexicon.get_messages_by_word("eat") == expected.get_messages_by_word("eat")
+        )
@@ -37,3 +37,56 @@ class TestModelUtils(unittest.TestCase):
         )
 
 
+
+    def test_select_predicted_scores_multiclass(self):
+        scores = np.array([
+            [0.1, 0.5, 0.4],
+            [0.7, 0.2, 0.1],
+            [0.3, 0.3, 0.4]
+        ])
+        classes = np.array(["b", "c", "a"])
+        self.assertTrue(
+            model_utils.select_predicted_scores(scores, ["c", "b", "a"], classes).tolist() == [0.5, 0.7, 0.4]
+        )
+        with self.assertRaises(ValueError):
+            model_utils.select_predicted_scores(scores, ["c", "d", "a"], classes)
+
+    def test_rank_predicted_scores(self):
+        scores = np.array([
+            [0.1, 0.5, 0.4, 0.0],
+            [0.7, 0.2, 0.1, 0.0],
+            [0.2, 0.1, 0.3, 0.4]
+        ])
+        classes = np.array(["one", "two", "three", "four"])
+
+        labels, top_scores, margins = model_utils.rank_predicted_scores(scores, classes, k=2)
+        self.assertTrue(
+            labels.tolist() == [["two", "three"], ["one", "two"], ["four", "three"]]
+        )
+        self.assertTrue(
+            top_scores.tolist() == [[0.5, 0.4], [0.7, 0.2], [0.4, 0.3]]
+        )
+        self.assertTrue(
+            np.allclose(margins, [0.1, 0.5, 0.1])
+        )
+
+        labels, top_scores, margins = model_utils.rank_predicted_scores(scores, classes)
+        self.assertTrue(
+            labels.tolist() == [["two"], ["one"], ["four"]]
+        )
+        self.assertTrue(
+            np.allclose(margins, [0.1, 0.5, 0.1])
+        )
+
+        labels, top_scores, margins = model_utils.rank_predicted_scores(scores, classes, k=4)
+        self.assertTrue(
+            labels[:, 0].tolist() == ["two", "one", "four"] and top_scores.shape == (3, 4)
+        )
+
+        labels, top_scores, margins = model_utils.rank_predicted_scores(np.array([1.5, -0.5]), ["no", "yes"])
+        self.assertTrue(
+            labels.tolist() == [["yes"], ["no"]]
+        )
+        self.assertTrue(
+            margins.tolist() == [3.0, 1.0]
+        )
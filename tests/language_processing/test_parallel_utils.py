@@ -0,0 +1,24 @@
+import unittest
+
+from core_ml_modules.language_processing import parallel_utils
+
+class TestParallelUtils(unittest.TestCase):
+    def test_iter_chunks(self):
+        self.assertTrue(
+            list(parallel_utils.iter_chunks(iter(range(7)), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+        )
+        self.assertTrue(
+            list(parallel_utils.iter_chunks([], 3)) == []
+        )
+
+    def test_map_chunks_in_processes(self):
+        chunks = parallel_utils.iter_chunks(range(20), 3)
+        self.assertTrue(
+            list(parallel_utils.map_chunks_in_processes(sum, chunks, 2)) ==
+            [sum(range(i, min(i + 3, 20))) for i in range(0, 20, 3)]
+        )
+
+    def test_get_n_workers(self):
+        self.assertTrue(parallel_utils.get_n_workers(None) == 1)
+        self.assertTrue(parallel_utils.get_n_workers(3) == 3)
+        self.assertTrue(parallel_utils.get_n_workers(-1) >= 1)
@@ -0,0 +1,79 @@
+import json
+import os
+import tempfile
+import unittest
+
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+
+from core_ml_modules.language_processing import estimators, profiling, Lexicon
+
+MESSAGES = ["I eat apples.", "You eat bananas?", "yes", "no thanks", "I eat bananas.", "no"]
+LABELS = ["food", "food", "answer", "answer", "food", "answer"]
+
+class TestStageProfiler(unittest.TestCase):
+    def make_pipeline(self):
+        lexicon = Lexicon(estimators.Tokeniser().transform(MESSAGES), [])
+        return Pipeline([
+            ("tokeniser", estimators.Tokeniser()),
+            ("ngrams", estimators.NGramFrequencyExtractor(lexicon, engine="csr")),
+            ("classifier", LogisticRegression())
+        ])
+
+    def test_profile_pipeline(self):
+        collector = profiling.InMemoryCollector()
+        pipeline = profiling.profile_pipeline(self.make_pipeline(), collector, trace_memory=True)
+
+        pipeline.fit(MESSAGES, LABELS)
+        self.assertTrue(
+            [(record["stage"], record["method"]) for record in collector.records] ==
+            [("tokeniser", "fit_transform"), ("ngrams", "fit_transform"), ("classifier", "fit")]
+        )
+
+        ngram_record = collector.records[1]
+        self.assertTrue(ngram_record["n_rows"] == len(MESSAGES))
+        self.assertTrue(ngram_record["output_shape"][0] == len(MESSAGES))
+        self.assertTrue(0 < ngram_record["output_density"] <= 1)
+        self.assertTrue(ngram_record["output_nnz"] > 0)
+        self.assertTrue(ngram_record["wall_seconds"] >= 0 and ngram_record["cpu_seconds"] >= 0)
+        self.assertTrue(ngram_record["peak_memory_bytes"] >= 0)
+        self.assertTrue("output_shape" not in collector.records[2])     # fit has no output to describe
+
+        self.assertTrue(
+            list(pipeline.predict(MESSAGES)) == list(self.make_pipeline().fit(MESSAGES, LABELS).predict(MESSAGES))
+        )
+        self.assertTrue(pipeline.predict_proba(MESSAGES).shape == (len(MESSAGES), 2))
+        self.assertTrue(
+            [(record["stage"], record["method"]) for record in collector.records[3:]] ==
+            [("tokeniser", "transform"), ("ngrams", "transform"), ("classifier", "predict"),
+             ("tokeniser", "transform"), ("ngrams", "transform"), ("classifier", "predict_proba")]
+        )
+        self.assertTrue(list(pipeline.classes_) == ["answer", "food"])
+
+    def test_collectors(self):
+        tokeniser = profiling.StageProfiler(estimators.Tokeniser())
+        tokeniser.fit_transform(MESSAGES)
+        self.assertTrue(tokeniser.collector_.records[0]["stage"] == "Tokeniser")
+        self.assertTrue(tokeniser.collector_.records[0]["peak_memory_bytes"] is None)
+        self.assertTrue(not hasattr(tokeniser, "predict"))
+
+        with tempfile.TemporaryDirectory() as path:
+            collector = profiling.JSONLinesCollector(os.path.join(path, "profile.jsonl"))
+            tokeniser = profiling.StageProfiler(estimators.Tokeniser(), name="tokens", collector=collector)
+            tokeniser.fit(MESSAGES)
+            tokeniser.transform(MESSAGES)
+
+            with open(collector.path) as f:
+                records = [json.loads(line) for line in f]
+            self.assertTrue([record["method"] for record in records] == ["fit", "transform"])
+            self.assertTrue(records[1]["rows_per_second"] > 0)
+            self.assertTrue("output_shape" not in records[0] and records[1]["output_shape"] == [len(MESSAGES)])
+
+        wrapped_pipeline = profiling.StageProfiler(self.make_pipeline())
+        wrapped_pipeline.fit(MESSAGES, LABELS)
+        self.assertTrue("output_shape" not in wrapped_pipeline.collector_.records[0])
+
+        tokeniser = profiling.StageProfiler(estimators.Tokeniser(), collector=profiling.LoggingCollector())
+        with self.assertLogs("core_ml_modules.language_processing.profiling") as logs:
+            tokeniser.transform(MESSAGES)
+        self.assertTrue(json.loads(logs.records[0].getMessage())["method"] == "transform")
@@ -0,0 +1,128 @@
+import asyncio
+import unittest
+
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+from sklearn.svm import SVC, LinearSVC
+
+from core_ml_modules.language_processing import estimators, model_utils, profiling, serving, Lexicon
+
+MESSAGES = ["I eat apples.", "You eat bananas?", "yes", "no thanks", "I eat bananas.", "no"]
+LABELS = ["food", "food", "answer", "answer", "food", "answer"]
+
+class TestMicroBatcher(unittest.TestCase):
+    def make_pipeline(self, classifier=None):
+        lexicon = Lexicon(estimators.Tokeniser().transform(MESSAGES), [])
+        pipeline = Pipeline([
+            ("tokeniser", estimators.Tokeniser()),
+            ("ngrams", estimators.NGramFrequencyExtractor(lexicon, engine="csr")),
+            ("classifier", LogisticRegression() if classifier is None else classifier)
+        ])
+        return pipeline.fit(MESSAGES * 5, LABELS * 5)
+
+    def test_predict(self):
+        pipeline = self.make_pipeline()
+        messages = MESSAGES * 5
+        collector = profiling.InMemoryCollector()
+
+        async def client():
+            async with serving.MicroBatcher(pipeline, max_batch_size=8, max_delay=0.1, collector=collector) as batcher:
+                predictions = await asyncio.gather(*[batcher.predict(message) for message in messages])
+                return predictions, batcher.get_stats()
+
+        predictions, stats = asyncio.run(client())
+
+        scores = pipeline.predict_proba(messages)
+        predicted_labels = pipeline.predict(messages)
+        expected_scores = model_utils.select_predicted_scores(scores, predicted_labels, pipeline.classes_)
+        self.assertTrue([label for label, _ in predictions] == predicted_labels.tolist())
+        self.assertTrue([score for _, score in predictions] == expected_scores.tolist())
+
+        self.assertTrue([record["batch_size"] for record in collector.records] == [8, 8, 8, 6])
+        self.assertTrue(stats["n_requests"] == len(messages))
+        self.assertTrue(stats["n_batches"] == 4)
+        self.assertTrue(stats["max_queue_depth"] == len(messages))
+        self.assertTrue(stats["queue_depth"] == 0)
+        self.assertTrue(
+            0 <= stats["latency_p50_seconds"] <= stats["latency_p90_seconds"] <= stats["latency_p99_seconds"]
+        )
+
+    def test_classifiers(self):
+        messages = MESSAGES + ["yes I eat", "no bananas", "apples?"]
+
+        # SVC's probabilities can disagree with its predictions, and LinearSVC only has decision_function
+        for classifier in [SVC(probability=True, random_state=0), LinearSVC()]:
+            pipeline = self.make_pipeline(classifier)
+
+            async def client():
+                async with serving.MicroBatcher(pipeline, max_delay=0.1) as batcher:
+                    return await asyncio.gather(*[batcher.predict(message) for message in messages])
+
+            predictions = asyncio.run(client())
+
+            predicted_labels = pipeline.predict(messages)
+            scores = pipeline.predict_proba(messages) if hasattr(pipeline, "predict_proba") else \
+                pipeline.decision_function(messages)
+            expected_scores = model_utils.select_predicted_scores(scores, predicted_labels, pipeline.classes_)
+            self.assertTrue([label for label, _ in predictions] == predicted_labels.tolist())
+            self.assertTrue([score for _, score in predictions] == expected_scores.tolist())
+
+    def test_max_delay(self):
+        pipeline = self.make_pipeline()
+        collector = profiling.InMemoryCollector()
+
+        async def client():
+            async with serving.MicroBatcher(pipeline, max_batch_size=64, max_delay=0, collector=collector) as batcher:
+                first = await batcher.predict("yes")
+                second = await batcher.predict("I eat apples.")
+                return first, second
+
+        first, second = asyncio.run(client())
+        self.assertTrue(first[0] == "answer" and second[0] == "food")
+        self.assertTrue([record["batch_size"] for record in collector.records] == [1, 1])
+
+    def test_errors(self):
+        pipeline = self.make_pipeline()
+
+        async def client():
+            async with serving.MicroBatcher(pipeline, max_delay=0.1) as batcher:
+                results = await asyncio.gather(batcher.predict("yes"), batcher.predict(None), return_exceptions=True)
+                return results, await batcher.predict("yes"), batcher.get_stats()
+
+        results, prediction, stats = asyncio.run(client())
+        self.assertTrue(all(isinstance(result, Exception) for result in results))
+        self.assertTrue(prediction[0] == "answer")
+        self.assertTrue(stats["n_requests"] == 1)
+
+    def test_failures(self):
+        pipeline = self.make_pipeline()
+
+        class FailingCollector:
+            def collect(self, record):
+                raise IOError("Disk full")
+
+        async def failing_collector_client():
+            async with serving.MicroBatcher(pipeline, max_delay=0, collector=FailingCollector()) as batcher:
+                return await batcher.predict("yes"), await batcher.predict("I eat apples.")
+
+        with self.assertLogs("core_ml_modules.language_processing.serving"):
+            first, second = asyncio.run(failing_collector_client())
+        self.assertTrue(first[0] == "answer" and second[0] == "food")
+
+        async def broken_batcher_client():
+            batcher = serving.MicroBatcher(pipeline, max_delay=0.1)
+
+            async def serve(loop, batch):
+                raise ValueError("Broken")
+            batcher._serve = serve
+
+            await batcher.start()
+            results = await asyncio.gather(batcher.predict("yes"), batcher.predict("no"), return_exceptions=True)
+            with self.assertRaises(RuntimeError):
+                await batcher.predict("yes")
+            await batcher.stop()
+            return results
+
+        with self.assertLogs("core_ml_modules.language_processing.serving"):
+            results = asyncio.run(asyncio.wait_for(broken_batcher_client(), 5))
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in results))
@@ -0,0 +1,60 @@
+import unittest
+
+import numpy as np
+
+from core_ml_modules.language_processing import Vocabulary, EncodedMessages
+
+MESSAGES = [
+    ["I", "eat", "apples", "."],
+    [],
+    ["You", "eat", "bananas", "?"]
+]
+
+class TestVocabulary(unittest.TestCase):
+    def test_add_get(self):
+        vocabulary = Vocabulary(["I", "eat", "I"])
+        self.assertTrue(len(vocabulary) == 2)
+        self.assertTrue(list(vocabulary) == ["I", "eat"])
+        self.assertTrue(vocabulary.add("apples") == 2)
+        self.assertTrue(vocabulary.add("I") == 0)
+        self.assertTrue(vocabulary.get_id("eat") == 1)
+        self.assertTrue(vocabulary.get_token(2) == "apples")
+        self.assertTrue("apples" in vocabulary)
+        self.assertTrue("oranges" not in vocabulary)
+        with self.assertRaises(AssertionError):
+            vocabulary.get_id("oranges")
+
+    def test_encode_decode(self):
+        vocabulary = Vocabulary(["I", "eat"])
+        self.assertTrue(
+            vocabulary.encode(["eat", "oranges"], add=False).tolist() == [1, -1]
+        )
+        self.assertTrue("oranges" not in vocabulary)
+        self.assertTrue(
+            vocabulary.encode(["eat", "oranges"]).tolist() == [1, 2]
+        )
+        self.assertTrue(
+            vocabulary.decode(np.array([2, 0])) == ["oranges", "I"]
+        )
+
+    def test_arrays(self):
+        vocabulary = Vocabulary(["I", "", "café", "a\nb", "I"])
+        data, offsets = vocabulary.to_arrays()
+        loaded = Vocabulary.from_arrays(data, offsets)
+        self.assertTrue(loaded.get_tokens() == ["I", "", "café", "a\nb"])
+        self.assertTrue(loaded.get_id("café") == 2)
+        self.assertTrue(loaded.lookup("oranges") == -1)
+
+class TestEncodedMessages(unittest.TestCase):
+    def test_encode(self):
+        encoded = EncodedMessages.encode(MESSAGES)
+        self.assertTrue(len(encoded) == 3)
+        self.assertTrue(encoded.ids.tolist() == [0, 1, 2, 3, 4, 1, 5, 6])
+        self.assertTrue(encoded.offsets.tolist() == [0, 4, 4, 8])
+        self.assertTrue(encoded.get_lengths().tolist() == [4, 0, 4])
+        self.assertTrue(encoded.get_ids(2).tolist() == [4, 1, 5, 6])
+        self.assertTrue(list(encoded) == MESSAGES)
+        self.assertTrue(encoded[-1] == MESSAGES[-1])
+
+        with self.assertRaises(AssertionError):
+            EncodedMessages([0, 1], [0, 1], encoded.vocabulary)